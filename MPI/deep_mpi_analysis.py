@@ -8,16 +8,28 @@ from sklearn.manifold import TSNE
 import matplotlib.pyplot as plt
 import seaborn as sns
 import pickle
-from collections import defaultdict
 import faiss
 from sentence_transformers import SentenceTransformer
 import time
+from embedding_store import load_store, dequantize
+from shared_arrays import share_array, scatter_rows
 
 # --------- MPI Setup ---------
 comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
 size = comm.Get_size()
 
+# Precision of the corpus rows sent to ranks: 'float32', 'float16' (2x smaller) or
+# 'int8' (4x smaller; needs the store's int8 copy, see embedding_store.write_quantized).
+# The school centroids, and so the saved similarity matrices and Ward linkages, are
+# computed from these rows: with 'float16' / 'int8' they are approximations of the
+# float32 results. Thematic top-k hits are exact either way (re-ranked if quantized).
+SHARE_PRECISION = 'float32'
+# With a quantized SHARE_PRECISION, rank 0 re-ranks k * RESCORE_CANDIDATES candidates
+# per school against the exact float32 vectors on disk (1 = keep the approximate top-k)
+RESCORE_CANDIDATES = 4
+RESCORE = max(RESCORE_CANDIDATES, 1) if SHARE_PRECISION != 'float32' else 1  # float32 scores are already exact
+
 # --------- Topics for Thematic Analysis ---------
 TOPICS = [
     "query: What is justice?",
@@ -56,62 +68,145 @@ TOPICS = [
 ]
 
 # --------- Helper Functions ---------
-def load_embeddings(path):
-    data = np.load(path, allow_pickle=True)
-    return data['embeddings'], data['metadata']
-
-def group_by_school(metadata, embeddings):
-    schools = defaultdict(list)
-    for i, meta in enumerate(metadata):
-        school = meta.get('school', 'Unknown')
-        schools[school].append(i)
-    return schools
-
-def average_school_embeddings(schools, embeddings):
+def distribute_corpus(path):
+    # Rank 0 opens the store; every rank receives only its own contiguous shard of
+    # the (possibly quantized) matrix and of the int32 school codes, as raw buffers
+    # (Scatterv). The school name table and int8 scales are pickled. Sentence texts
+    # and the full-precision vectors stay on rank 0, which uses them once results
+    # are reduced.
+    store = emb = scale = codes = names = error = None
+    if rank == 0:
+        try:
+            store = load_store(path)
+            emb, scale = store.vectors(SHARE_PRECISION)
+            codes, names = store.codes['school'], store.names['school']
+        except ValueError as e:  # e.g. a store with incremental updates, not yet compacted
+            error = str(e)
+    error = comm.bcast(error, root=0)  # every rank stops, instead of waiting in Scatterv
+    if error:
+        raise SystemExit(error if rank == 0 else 1)
+    emb, first_row, _ = scatter_rows(emb, comm)
+    codes, _, _ = scatter_rows(codes, comm)
+    names, scale = comm.bcast((names, scale), root=0)
+    return emb, scale, codes, names, first_row, store
+
+def school_centroids(embeddings, school_codes, school_names, scale=None, block_size=65536):
+    # {school: mean vector}. Each rank sums its own shard per school code with
+    # np.add.at (no per-school row copies), then one Allreduce combines the
+    # (schools x dim) sums and the counts
+    n_slots = len(school_names) + 1  # slot 0 = 'Unknown' (code -1)
+    sums = np.zeros((n_slots, embeddings.shape[1] + 1), dtype='float64')  # last column: counts
+    for start in range(0, len(embeddings), block_size):
+        block = dequantize(embeddings[start:start + block_size], SHARE_PRECISION, scale)
+        slots = np.asarray(school_codes[start:start + block_size]) + 1
+        np.add.at(sums[:, :-1], slots, block)
+        sums[:, -1] += np.bincount(slots, minlength=n_slots)
+    comm.Allreduce(MPI.IN_PLACE, sums, op=MPI.SUM)
     school_vecs = {}
-    for school, idxs in schools.items():
-        school_vecs[school] = np.mean(embeddings[idxs], axis=0)
+    for slot in np.flatnonzero(sums[:, -1]):
+        school = school_names[slot - 1] if slot > 0 else 'Unknown'
+        school_vecs[school] = (sums[slot, :-1] / sums[slot, -1]).astype('float32')
     return school_vecs
 
-def split_work(items):
-    # Split a list of items across MPI ranks
-    n = len(items)
-    chunk = n // size
-    start = rank * chunk
-    end = (rank + 1) * chunk if rank < size - 1 else n
-    return items[start:end]
+def cosine_scores(qvecs, embeddings, scale=None, block_size=65536):
+    # (rows x topics) cosine similarities, computed block-wise so only one block of
+    # the (possibly memory-mapped or quantized) corpus is converted to float32 at a time
+    scores = np.empty((len(embeddings), len(qvecs)), dtype='float32')
+    for start in range(0, len(embeddings), block_size):
+        block = dequantize(embeddings[start:start + block_size], SHARE_PRECISION, scale)
+        norms = np.linalg.norm(block, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        scores[start:start + block_size] = (block @ qvecs.T) / norms
+    return scores
+
+def local_top_k(qvecs, embeddings, school_codes, n_codes, k, scale=None, first_row=0):
+    # Top-k rows per (school, topic) within this rank's row shard (global rows start
+    # at first_row), as a fixed-size (n_codes + 1, topics, k, 2) array of
+    # (similarity, row) pairs padded with (-inf, -1); slot 0 is 'Unknown' (code -1),
+    # slot c + 1 is school code c
+    scores = cosine_scores(qvecs, embeddings, scale)
+    codes = np.asarray(school_codes)
+    top = np.full((n_codes + 1, len(qvecs), k, 2), -np.inf)
+    top[..., 1] = -1
+    order = np.argsort(codes, kind='stable')
+    sorted_codes = codes[order]
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]]) if len(order) else []
+    for start, end in zip(starts, list(starts[1:]) + [len(order)]):
+        idxs = order[start:end]
+        school_scores = scores[idxs]
+        kk = min(k, len(idxs))
+        best = np.argpartition(-school_scores, kk - 1, axis=0)[:kk]  # (kk x topics)
+        slot = top[sorted_codes[start] + 1]
+        slot[:, :kk, 0] = np.take_along_axis(school_scores, best, axis=0).T
+        slot[:, :kk, 1] = (idxs[best] + first_row).T
+    return top
+
+def merge_top_k(a, b, k):
+    # Best k of two (..., k, 2) arrays of (similarity, row) pairs
+    both = np.concatenate([a, b], axis=-2)
+    best = np.argsort(-both[..., 0], axis=-1, kind='stable')[..., :k]
+    return np.take_along_axis(both, best[..., None], axis=-2)
+
+def reduce_top_k(top, k):
+    # Tree reduction of the fixed-size per-rank arrays to rank 0 with a custom MPI op;
+    # one datatype element is one k-list, so the op never sees a partial list
+    unit = MPI.DOUBLE.Create_contiguous(2 * k).Commit()
+    def op_fn(inbuf, inoutbuf, datatype):
+        a = np.frombuffer(inbuf, dtype='float64').reshape(-1, k, 2)
+        b = np.frombuffer(inoutbuf, dtype='float64').reshape(-1, k, 2)
+        b[...] = merge_top_k(a, b, k)
+    op = MPI.Op.Create(op_fn, commute=True)
+    send = np.ascontiguousarray(top, dtype='float64')
+    recv = np.empty_like(send) if rank == 0 else None
+    comm.Reduce([send, send.size // (2 * k), unit], [recv, send.size // (2 * k), unit] if rank == 0 else None,
+                op=op, root=0)
+    op.Free()
+    unit.Free()
+    return recv
+
+def top_k_to_hits(top, school_names):
+    # Rank 0: (n_codes + 1, topics, k, 2) -> per topic {school: [{'similarity', 'row'}]}
+    results = [{} for _ in range(top.shape[1])]
+    for slot in range(top.shape[0]):
+        school = school_names[slot - 1] if slot > 0 else 'Unknown'
+        for t in range(top.shape[1]):
+            hits = [{'similarity': float(sim), 'row': int(row)} for sim, row in top[slot, t] if row >= 0]
+            hits.sort(key=lambda hit: -hit['similarity'])
+            if hits:
+                results[t][school] = hits
+    return results
+
+def finalize_hits(domain_hits, store, qvec, k):
+    # Rank 0 only: exact re-ranking of the candidates and sentence texts for the top k
+    for school, hits in domain_hits.items():
+        rows = np.array([hit['row'] for hit in hits], dtype='int64')
+        if RESCORE > 1 and len(rows):
+            exact = store.rescore(qvec[None, :], rows)[0]
+            hits = [{'similarity': float(exact[j]), 'row': int(rows[j])} for j in np.argsort(-exact)]
+        hits = hits[:k]
+        for hit in hits:
+            hit['text'] = store.sentence(hit['row'])  # text_key is 'sentence_str' or 'text' by corpus
+        domain_hits[school] = hits
 
 def save_pickle(obj, fname):
     if rank == 0:
         with open(fname, 'wb') as f:
             pickle.dump(obj, f)
 
-# --------- Load Data (on rank 0, then broadcast) ---------
+# --------- Load Data (on rank 0, then scatter row shards) ---------
 if rank == 0:
     print("Loading embeddings...")
-    emb_phil, meta_phil = load_embeddings('philosophy_embeddings_merged.npz')
-    emb_reli, meta_reli = load_embeddings('religion_embeddings_merged.npz')
-    emb_unified, meta_unified = load_embeddings('religion_philosophy_embeddings_merged.npz')
-else:
-    emb_phil = emb_reli = emb_unified = None
-    meta_phil = meta_reli = meta_unified = None
-
-# Broadcast data to all ranks
-emb_phil = comm.bcast(emb_phil, root=0)
-meta_phil = comm.bcast(meta_phil, root=0)
-emb_reli = comm.bcast(emb_reli, root=0)
-meta_reli = comm.bcast(meta_reli, root=0)
-emb_unified = comm.bcast(emb_unified, root=0)
-meta_unified = comm.bcast(meta_unified, root=0)
+emb_phil, scale_phil, codes_phil, names_phil, first_phil, store_phil = distribute_corpus('philosophy_store')
+emb_reli, scale_reli, codes_reli, names_reli, first_reli, store_reli = distribute_corpus('religion_store')
+emb_unified, scale_unified, codes_unified, names_unified, first_unified, store_unified = distribute_corpus('religion_philosophy_store')
 
 # --------- School-level Embedding Averages ---------
-schools_phil = group_by_school(meta_phil, emb_phil)
-schools_reli = group_by_school(meta_reli, emb_reli)
-schools_unified = group_by_school(meta_unified, emb_unified)
-
-school_vecs_phil = average_school_embeddings(schools_phil, emb_phil)
-school_vecs_reli = average_school_embeddings(schools_reli, emb_reli)
-school_vecs_unified = average_school_embeddings(schools_unified, emb_unified)
+t0 = time.time()
+school_vecs_phil = school_centroids(emb_phil, codes_phil, names_phil, scale_phil)
+school_vecs_reli = school_centroids(emb_reli, codes_reli, names_reli, scale_reli)
+school_vecs_unified = school_centroids(emb_unified, codes_unified, names_unified, scale_unified)
+if rank == 0:
+    print(f"School centroids in {time.time() - t0:.2f}s over {size} ranks")
 
 # Gather school names for each domain
 school_names_phil = sorted(school_vecs_phil.keys())
@@ -151,46 +246,42 @@ if rank == 0:
     # You can add 'average', 'complete', etc. if desired
 
 # --------- Thematic Analysis (Distributed) ---------
+# Every rank scores all topics against its own shard of corpus rows and keeps a
+# fixed-size top-k per (school, topic); the shards are merged with an MPI reduction,
+# so the work scales with rank count and corpus size rather than the topic count.
 if rank == 0:
     print("Starting thematic analysis...")
-model = SentenceTransformer("e5-large-v2")
-
-my_topics = split_work(TOPICS)
-thematic_results = {}
-
-topic_times = []
-for idx, topic in enumerate(my_topics):
-    t_start = time.time()
-    qvec = model.encode([topic], normalize_embeddings=True)
-    results = {}
-    for domain, emb, meta, schools, school_vecs in [
-        ('philosophy', emb_phil, meta_phil, schools_phil, school_vecs_phil),
-        ('religion', emb_reli, meta_reli, schools_reli, school_vecs_reli)
-    ]:
-        school_hits = {}
-        for school, idxs in schools.items():
-            sims_texts = []
-            for i in idxs:
-                sim = float(np.dot(qvec, emb[i].reshape(-1)).item() / (np.linalg.norm(qvec) * np.linalg.norm(emb[i])))
-                sims_texts.append((sim, meta[i].get('sentence_str', '')))
-            top_n = sorted(sims_texts, reverse=True)[:5]
-            school_hits[school] = [{'similarity': sim, 'text': text} for sim, text in top_n]
-        results[domain] = school_hits
-    thematic_results[topic] = results
-    t_end = time.time()
-    topic_times.append(t_end - t_start)
-    avg_time = np.mean(topic_times)
-    remaining = (len(my_topics) - (idx + 1)) * avg_time
-    print(f"[Rank {rank}] Finished topic {idx+1}/{len(my_topics)}: '{topic}' in {t_end - t_start:.2f}s. "
-          f"Avg/topic: {avg_time:.2f}s. Est. remaining: {remaining/60:.1f} min.")
-
-# Gather all thematic results at rank 0
-all_thematic_results = comm.gather(thematic_results, root=0)
+t_start = time.time()
+if rank == 0:
+    # Only rank 0 loads the model; one batched forward pass for all topics
+    model = SentenceTransformer("e5-large-v2")
+    qvecs = model.encode(TOPICS, normalize_embeddings=True).astype('float32')
+else:
+    qvecs = None
+qvecs = share_array(qvecs, comm)
+t_encoded = time.time()
+
+k_candidates = 5 * RESCORE
+per_domain = {}
+for domain, emb, scale, codes, names, first_row in [
+    ('philosophy', emb_phil, scale_phil, codes_phil, names_phil, first_phil),
+    ('religion', emb_reli, scale_reli, codes_reli, names_reli, first_reli)
+]:
+    top = local_top_k(qvecs, emb, codes, len(names), k_candidates, scale, first_row)
+    per_domain[domain] = reduce_top_k(top, k_candidates)
+
+t_end = time.time()
+print(f"[Rank {rank}] Scored {len(TOPICS)} topics against {len(emb_phil)} philosophy and {len(emb_reli)} religion rows "
+      f"in {t_end - t_start:.2f}s (encoding {t_encoded - t_start:.2f}s, similarity + top-k {t_end - t_encoded:.2f}s).")
 
 if rank == 0:
+    hits_phil = top_k_to_hits(per_domain['philosophy'], names_phil)
+    hits_reli = top_k_to_hits(per_domain['religion'], names_reli)
     thematic_results_merged = {}
-    for d in all_thematic_results:
-        thematic_results_merged.update(d)
+    for t, topic in enumerate(TOPICS):
+        thematic_results_merged[topic] = {'philosophy': hits_phil[t], 'religion': hits_reli[t]}
+        finalize_hits(hits_phil[t], store_phil, qvecs[t], k=5)
+        finalize_hits(hits_reli[t], store_reli, qvecs[t], k=5)
 
 # --------- Save All Results ---------
 if rank == 0:
@@ -3,46 +3,307 @@ import pandas as pd
 from sentence_transformers import SentenceTransformer
 import numpy as np
 import os
+import re
+import json
+import glob
+import hashlib
+import time
+from collections import defaultdict
 
 # MPI setup
 comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
 size = comm.Get_size()
 
-# Config
+# Config (pipeline.py overrides the input/output settings through EMBED_* environment variables)
 MODEL_NAME = 'intfloat/e5-large-v2'  # or 'bge-large-en-v1.5'
-INPUT_FILE = 'philosophy_data.csv' # or 'religion_data.csv'
-TEXT_COLUMN = 'sentence_str'  # use original sentence
-OUTPUT_DIR = 'embeddings_output'
+INPUT_FILE = os.environ.get('EMBED_INPUT_FILE', 'philosophy_data.csv') # or 'religion_data.csv', or a .parquet file
+TEXT_COLUMN = os.environ.get('EMBED_TEXT_COLUMN', 'sentence_str')  # use original sentence
+METADATA_COLUMNS = os.environ.get('EMBED_METADATA_COLUMNS', 'title,author,school,sentence_str').split(',')
+PREFIX = 'passage: '  # e5-style passage prefix
+OUTPUT_DIR = os.environ.get('EMBED_OUTPUT_DIR', 'embeddings_output')
+CACHE_DIR = 'embedding_cache'  # persistent (model, prefix, sentence) -> vector cache
+TOKENS_PER_BATCH = 20000  # estimated tokens per work item handed out by the master
+CHECKPOINT_EVERY = 20  # batches per shard checkpoint written by each worker
+CACHE_MAX_SEGMENTS = 64  # merge the cache into one segment (one vector per sentence) beyond this
 
-# Ensure output directory exists
-if rank == 0 and not os.path.exists(OUTPUT_DIR):
-    os.makedirs(OUTPUT_DIR)
+# Message tags
+TAG_REQUEST, TAG_WORK, TAG_STOP = 1, 2, 3
+
+# Ensure output directories exist
+if rank == 0:
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    os.makedirs(CACHE_DIR, exist_ok=True)
 comm.Barrier()  # Sync all processes
 
-# Load data
-df = pd.read_csv(INPUT_FILE)
-chunks = np.array_split(df, size)
-local_df = chunks[rank].reset_index(drop=True)
 
-# Add prefix for e5-style models
-sentences = ['passage: ' + s for s in local_df[TEXT_COLUMN].tolist()]
+def estimate_tokens(texts):
+    # ~4 characters per wordpiece plus [CLS]/[SEP] and the 'passage: ' prefix
+    return texts.fillna('').str.len().to_numpy() // 4 + 4
+
+
+def make_batches(row_ids, token_counts, tokens_per_batch):
+    # Runs of consecutive rows of roughly equal token cost, largest first so the
+    # last batches handed out (the ones that decide the finish time) are small
+    batches, start, total = [], 0, 0
+    for i, n in enumerate(token_counts):
+        total += n
+        if total >= tokens_per_batch:
+            batches.append((row_ids[start:i + 1], total))
+            start, total = i + 1, 0
+    if start < len(token_counts):
+        batches.append((row_ids[start:], total))
+    batches.sort(key=lambda b: b[1], reverse=True)
+    return [rows for rows, _ in batches]
+
+
+def sentence_key(sentence):
+    # Cache key: model, prefix and whitespace-normalized sentence
+    normalized = re.sub(r'\s+', ' ', str(sentence)).strip()
+    return hashlib.md5(f'{MODEL_NAME}\0{PREFIX}\0{normalized}'.encode('utf-8')).hexdigest().encode('ascii')
+
+
+def atomic_save(path, save_fn, **arrays):
+    # Write to a temporary name first so a crash never leaves a half-written file
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        save_fn(f, **arrays)
+    os.replace(tmp, path)
+
+
+def input_fingerprint():
+    stat = os.stat(INPUT_FILE)
+    return {'input': os.path.abspath(INPUT_FILE), 'size': stat.st_size, 'mtime': stat.st_mtime,
+            'model': MODEL_NAME, 'prefix': PREFIX}
+
+
+class Checkpointer:
+    """Buffers encoded rows and flushes them as a shard plus a cache segment."""
+
+    def __init__(self, run_id, name):
+        self.run_id = run_id
+        self.name = name
+        self.part = 0
+        self.clear()
+
+    def clear(self):
+        self.embeddings, self.indices, self.metadata = [], [], []
+
+    def add(self, row_ids, rows, embeddings):
+        self.embeddings.append(np.asarray(embeddings, dtype='float32'))
+        self.indices.append(np.asarray(row_ids))
+        self.metadata.extend(rows)
+
+    def flush(self, write_cache=True):
+        if not self.metadata:
+            return
+        stem = f'{self.name}_{self.run_id}_{self.part:05d}'
+        embeddings = np.vstack(self.embeddings)
+        atomic_save(os.path.join(OUTPUT_DIR, f'embeddings_rank_{stem}.npz'), np.savez_compressed,
+                    embeddings=embeddings, indices=np.concatenate(self.indices), metadata=self.metadata)
+        if write_cache:
+            keys = np.array([sentence_key(r[TEXT_COLUMN]) for r in self.metadata], dtype='S32')
+            atomic_save(os.path.join(CACHE_DIR, f'vecs_{stem}.npy'), np.save, arr=embeddings)
+            atomic_save(os.path.join(CACHE_DIR, f'keys_{stem}.npy'), np.save, arr=keys)
+        self.part += 1
+        self.clear()
+
 
-# Load model
-model = SentenceTransformer(MODEL_NAME)
+def load_cache_index():
+    # key -> (segment, row); only the small key arrays are read, vectors stay on disk
+    segments, lookup = [], {}
+    for keys_path in sorted(glob.glob(os.path.join(CACHE_DIR, 'keys_*.npy'))):
+        vecs_path = keys_path.replace('keys_', 'vecs_', 1)
+        if not os.path.exists(vecs_path):
+            continue
+        seg = len(segments)
+        segments.append(vecs_path)
+        for row, key in enumerate(np.load(keys_path)):
+            lookup[bytes(key)] = (seg, row)
+    return segments, lookup
 
-# Encode
-embeddings = model.encode(sentences, show_progress_bar=True, normalize_embeddings=True)
 
-# Save embeddings and metadata
-output_path = os.path.join(OUTPUT_DIR, f'embeddings_rank_{rank}.npz')
-np.savez_compressed(
-    output_path,
-    embeddings=embeddings,
-    indices=local_df.index.values,
-    metadata=local_df[['title', 'author', 'school', 'sentence_str']].to_dict('records')
-)
+def compact_cache(run_id):
+    # Past CACHE_MAX_SEGMENTS, copy one vector per key into a single segment (read
+    # segment by segment from disk) and remove the old segments
+    segments, lookup = load_cache_index()
+    if len(segments) <= CACHE_MAX_SEGMENTS:
+        return
+    rows_by_segment = defaultdict(list)
+    for key, (seg, row) in lookup.items():
+        rows_by_segment[seg].append((row, key))
+    first = np.load(segments[0], mmap_mode='r')
+    stem = f'compact_{run_id}'
+    vecs_path = os.path.join(CACHE_DIR, f'vecs_{stem}.npy')
+    out = np.lib.format.open_memmap(vecs_path + '.tmp', mode='w+', dtype=first.dtype,
+                                    shape=(len(lookup), first.shape[1]))
+    keys, n = [], 0
+    for seg, hits in sorted(rows_by_segment.items()):
+        hits.sort()
+        out[n:n + len(hits)] = np.load(segments[seg], mmap_mode='r')[[row for row, _ in hits]]
+        keys.extend(key for _, key in hits)
+        n += len(hits)
+    out.flush()
+    del out
+    os.replace(vecs_path + '.tmp', vecs_path)
+    atomic_save(os.path.join(CACHE_DIR, f'keys_{stem}.npy'), np.save, arr=np.array(keys, dtype='S32'))
+    for path in segments:
+        os.remove(path)
+        os.remove(path.replace('vecs_', 'keys_', 1))
+    print(f"Embedding cache: merged {len(segments)} segments into one ({len(keys)} sentences)")
 
+
+def completed_rows():
+    # Rows already embedded by an earlier (interrupted) run over the same input
+    state_path = os.path.join(OUTPUT_DIR, 'run_state.json')
+    fingerprint = input_fingerprint()
+    shards = glob.glob(os.path.join(OUTPUT_DIR, 'embeddings_rank_*.npz'))
+    done = set()
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            previous = json.load(f)
+    else:
+        previous = None
+    if previous == fingerprint:
+        for shard in shards:
+            with np.load(shard, allow_pickle=True) as data:
+                done.update(data['indices'].tolist())
+    else:
+        # Different input: row numbers in old shards no longer apply. Shard vectors
+        # from the same model and prefix that the cache lacks (normally none: encoded
+        # rows are cached when flushed) are kept in it, then the shards are dropped.
+        reusable = previous is not None and (previous['model'], previous['prefix']) == (MODEL_NAME, PREFIX)
+        cached_keys = load_cache_index()[1] if reusable and shards else {}
+        for n, shard in enumerate(shards):
+            if reusable:
+                with np.load(shard, allow_pickle=True) as data:
+                    keys = np.array([sentence_key(m[TEXT_COLUMN]) for m in data['metadata']], dtype='S32')
+                    missing = np.array([bytes(k) not in cached_keys for k in keys], dtype=bool)
+                    if missing.any():
+                        stem = f'stale_{int(time.time() * 1000):x}_{n:05d}'
+                        atomic_save(os.path.join(CACHE_DIR, f'vecs_{stem}.npy'), np.save,
+                                    arr=data['embeddings'][missing])
+                        atomic_save(os.path.join(CACHE_DIR, f'keys_{stem}.npy'), np.save, arr=keys[missing])
+                        cached_keys.update(dict.fromkeys(keys[missing].tolist()))
+            os.remove(shard)
+        with open(state_path, 'w') as f:
+            json.dump(fingerprint, f, indent=2)
+    return done
+
+
+def encode_rows(model, rows):
+    sentences = [PREFIX + str(r[TEXT_COLUMN]) for r in rows]
+    return model.encode(sentences, normalize_embeddings=True)
+
+
+def plan_work(run_id):
+    # Master-side: skip finished rows, serve cached sentences from disk, batch the rest
+    if INPUT_FILE.endswith('.parquet'):
+        df = pd.read_parquet(INPUT_FILE, columns=METADATA_COLUMNS)
+    else:
+        df = pd.read_csv(INPUT_FILE, usecols=METADATA_COLUMNS)
+    done = completed_rows()
+    todo = np.array([i for i in range(len(df)) if i not in done], dtype='int64')
+
+    compact_cache(run_id)
+    segments, lookup = load_cache_index()
+    keys = [sentence_key(s) for s in df[TEXT_COLUMN].to_numpy()[todo]]
+    hits_by_segment = defaultdict(list)
+    hit_rows = set()
+    for row, key in zip(todo, keys):
+        if key in lookup:
+            seg, seg_row = lookup[key]
+            hits_by_segment[seg].append((row, seg_row))
+            hit_rows.add(row)
+
+    cached = Checkpointer(run_id, 'cached')
+    for seg, seg_hits in sorted(hits_by_segment.items()):
+        vecs = np.load(segments[seg], mmap_mode='r')
+        row_ids = np.array([row for row, _ in seg_hits])
+        cached.add(row_ids, df.iloc[row_ids][METADATA_COLUMNS].to_dict('records'),
+                   vecs[np.array([seg_row for _, seg_row in seg_hits])])
+        if len(cached.metadata) >= 100_000:
+            cached.flush(write_cache=False)
+    cached.flush(write_cache=False)
+
+    missing = np.array([row for row in todo if row not in hit_rows], dtype='int64')
+    batches = make_batches(missing, estimate_tokens(df[TEXT_COLUMN].iloc[missing]), TOKENS_PER_BATCH)
+    print(f"{len(df)} sentences: {len(done)} already checkpointed, {len(hit_rows)} from cache, "
+          f"{len(missing)} to encode in {len(batches)} batches")
+    return df, batches
+
+
+comm.Barrier()
+t_start = MPI.Wtime()
+run_id = comm.bcast(f'{int(time.time() * 1000):x}' if rank == 0 else None, root=0)
+
+n_encoded = 0
+busy_time = 0.0
+
+if size == 1:
+    # Nothing to schedule: work through the batches locally
+    df, batches = plan_work(run_id)
+    model = SentenceTransformer(MODEL_NAME) if batches else None
+    checkpointer = Checkpointer(run_id, str(rank))
+    for b, row_ids in enumerate(batches, 1):
+        rows = df.iloc[row_ids][METADATA_COLUMNS].to_dict('records')
+        t0 = MPI.Wtime()
+        checkpointer.add(row_ids, rows, encode_rows(model, rows))
+        busy_time += MPI.Wtime() - t0
+        n_encoded += len(rows)
+        if b % CHECKPOINT_EVERY == 0:
+            checkpointer.flush()
+    checkpointer.flush()
+elif rank == 0:
+    # Master: the only rank that reads the input (and only the columns we keep);
+    # hands out token-balanced row batches on demand until the queue is empty
+    df, batches = plan_work(run_id)
+    print(f"Scheduling {len(batches)} batches over {size - 1} workers")
+
+    status = MPI.Status()
+    next_batch, active_workers = 0, size - 1
+    while active_workers:
+        comm.recv(source=MPI.ANY_SOURCE, tag=TAG_REQUEST, status=status)
+        worker = status.Get_source()
+        if next_batch < len(batches):
+            row_ids = batches[next_batch]
+            next_batch += 1
+            comm.send((row_ids, df.iloc[row_ids][METADATA_COLUMNS].to_dict('records')), dest=worker, tag=TAG_WORK)
+        else:
+            comm.send(None, dest=worker, tag=TAG_STOP)
+            active_workers -= 1
+else:
+    # Worker: ask for a batch, encode it, checkpoint every CHECKPOINT_EVERY batches
+    model = None
+    checkpointer = Checkpointer(run_id, str(rank))
+    status = MPI.Status()
+    b = 0
+    while True:
+        comm.send(rank, dest=0, tag=TAG_REQUEST)
+        work = comm.recv(source=0, tag=MPI.ANY_TAG, status=status)
+        if status.Get_tag() == TAG_STOP:
+            break
+        row_ids, rows = work
+        model = model or SentenceTransformer(MODEL_NAME)
+        t0 = MPI.Wtime()
+        checkpointer.add(row_ids, rows, encode_rows(model, rows))
+        busy_time += MPI.Wtime() - t0
+        n_encoded += len(rows)
+        b += 1
+        if b % CHECKPOINT_EVERY == 0:
+            checkpointer.flush()
+    checkpointer.flush()
+
+finish_time = MPI.Wtime() - t_start
+
+# Straggler report: how far the slowest worker finished behind the fastest one
+timings = comm.gather((rank, finish_time, busy_time, n_encoded), root=0)
 if rank == 0:
+    workers = [t for t in timings if t[3] > 0]
+    if workers:
+        finishes = [t[1] for t in workers]
+        for r, finish, busy, n in workers:
+            print(f"  rank {r}: {n} sentences, busy {busy:.1f}s, finished at {finish:.1f}s")
+        print(f"Wall clock {max(finishes):.1f}s, straggler gap (last - first finish) "
+              f"{max(finishes) - min(finishes):.1f}s")
     print(f"Embedding completed with model {MODEL_NAME}. Outputs saved to {OUTPUT_DIR}/embeddings_rank_*.npz")
-
@@ -0,0 +1,429 @@
+import os
+import sys
+import json
+import time
+import shutil
+import numpy as np
+
+# On-disk layout of a merged corpus (a directory), readable without pickle:
+#   store.json              manifest: rows, dim, dtype, text key, categorical fields
+#   embeddings.npy          (rows x dim) float32/float16 matrix, opened with mmap_mode='r'
+#   <field>_codes.npy       int32 code per row for each categorical field (school, title, author)
+#   <field>_names.json      code -> string table for that field
+#   sentences.bin           all sentences, utf-8, concatenated
+#   sentence_offsets.npy    int64 (rows + 1) byte offsets into sentences.bin
+#   embeddings_<kind>.npy   optional compact copies ('float16' or 'int8') for search/RAM,
+#   int8_scale.npy          with per-dimension scales for int8; the full-precision matrix
+#                           stays on disk for exact rescoring of top candidates
+#
+# Everything is memory-mapped, so several processes opening the same store share
+# the page cache instead of each decompressing and unpickling its own copy.
+#
+# Incremental updates (see index_updates.py) never rewrite these files:
+#   segments/seg_<n>/       a complete store per added title, with ids continuing
+#                           after the last row of the base store / previous segment
+#   updates.jsonl           append-only log of 'add' (segment, first_id, rows) and
+#                           'remove' (title) entries; load_store() then returns a
+#                           SegmentedStore over the base and its segments
+
+MANIFEST_FILE = 'store.json'
+UPDATES_LOG = 'updates.jsonl'
+SEGMENTS_DIR = 'segments'
+TEXT_KEYS = ('sentence_str', 'text')
+QUANTIZED_KINDS = ('float16', 'int8')
+CHUNK_ROWS = 65536
+
+
+def int8_scale(embeddings):
+    # Symmetric per-dimension scale so that max |x_d| maps to 127
+    max_abs = np.zeros(embeddings.shape[1], dtype='float32')
+    for start in range(0, len(embeddings), CHUNK_ROWS):
+        block = np.abs(np.asarray(embeddings[start:start + CHUNK_ROWS], dtype='float32'))
+        np.maximum(max_abs, block.max(axis=0), out=max_abs)
+    max_abs[max_abs == 0] = 1.0
+    return max_abs / 127.0
+
+
+def quantize(x, kind, scale=None):
+    x = np.asarray(x, dtype='float32')
+    if kind == 'float16':
+        return x.astype('float16')
+    if kind == 'int8':
+        return np.clip(np.rint(x / scale), -127, 127).astype('int8')
+    return x
+
+
+def dequantize(q, kind, scale=None):
+    if kind == 'int8':
+        return q.astype('float32') * scale
+    return np.asarray(q, dtype='float32')
+
+
+def write_quantized(store_dir, kind):
+    """Add a compact copy of a store's matrix ('float16' or 'int8'), chunk by chunk."""
+    if kind not in QUANTIZED_KINDS:
+        raise ValueError(f"Unknown quantization '{kind}', expected one of {QUANTIZED_KINDS}")
+    embeddings = np.load(os.path.join(store_dir, 'embeddings.npy'), mmap_mode='r')
+    scale = None
+    if kind == 'int8':
+        scale = int8_scale(embeddings)
+        np.save(os.path.join(store_dir, 'int8_scale.npy'), scale)
+    out = np.lib.format.open_memmap(os.path.join(store_dir, f'embeddings_{kind}.npy'), mode='w+',
+                                    dtype=kind, shape=embeddings.shape)
+    for start in range(0, len(embeddings), CHUNK_ROWS):
+        out[start:start + CHUNK_ROWS] = quantize(embeddings[start:start + CHUNK_ROWS], kind, scale)
+    out.flush()
+
+    manifest_path = os.path.join(store_dir, MANIFEST_FILE)
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    manifest['quantized'] = sorted(set(manifest.get('quantized', [])) | {kind})
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+
+class StoreWriter:
+    """Streams rows into a store directory with a preallocated, memory-mapped matrix.
+
+    Only the chunk being appended is held in RAM besides the (small) code arrays,
+    so a corpus can be written shard by shard.
+    """
+
+    def __init__(self, store_dir, rows, dim, dtype='float32'):
+        os.makedirs(store_dir, exist_ok=True)
+        # A rewritten store starts without incremental updates
+        if os.path.exists(os.path.join(store_dir, UPDATES_LOG)):
+            os.remove(os.path.join(store_dir, UPDATES_LOG))
+        shutil.rmtree(os.path.join(store_dir, SEGMENTS_DIR), ignore_errors=True)
+        self.store_dir = store_dir
+        self.rows = rows
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.embeddings = np.lib.format.open_memmap(
+            os.path.join(store_dir, 'embeddings.npy'), mode='w+', dtype=self.dtype, shape=(rows, dim))
+        self.offsets = np.zeros(rows + 1, dtype='int64')
+        self._sentences = open(os.path.join(store_dir, 'sentences.bin'), 'wb')
+        self.text_key = None
+        self.fields = None
+        self.codes = {}
+        self._lookups = {}
+        self.names = {}
+        self.n = 0
+
+    def _init_fields(self, meta):
+        keys = list(meta.keys())
+        self.text_key = next((k for k in TEXT_KEYS if k in keys), None)
+        self.fields = [k for k in keys if k != self.text_key]
+        for field in self.fields:
+            self.codes[field] = np.full(self.rows, -1, dtype='int32')
+            self._lookups[field] = {}
+            self.names[field] = []
+
+    def append(self, embeddings, metadata):
+        """Append a chunk of rows: (n x dim) embeddings and n metadata dicts."""
+        n = len(metadata)
+        if self.n + n > self.rows:
+            raise ValueError(f"Store was sized for {self.rows} rows, got {self.n + n}")
+        if self.fields is None and n:
+            self._init_fields(metadata[0])
+        self.embeddings[self.n:self.n + n] = np.asarray(embeddings).astype(self.dtype, copy=False)
+        for j, meta in enumerate(metadata):
+            i = self.n + j
+            for field in self.fields:
+                value = meta.get(field)
+                if value is None:
+                    continue
+                value = str(value)
+                lookup = self._lookups[field]
+                if value not in lookup:
+                    lookup[value] = len(self.names[field])
+                    self.names[field].append(value)
+                self.codes[field][i] = lookup[value]
+            encoded = str(meta.get(self.text_key) or '').encode('utf-8') if self.text_key else b''
+            self._sentences.write(encoded)
+            self.offsets[i + 1] = self.offsets[i] + len(encoded)
+        self.n += n
+
+    def close(self):
+        if self.n != self.rows:
+            raise ValueError(f"Store was sized for {self.rows} rows but only {self.n} were written")
+        self._sentences.close()
+        self.embeddings.flush()
+        fields = self.fields or []
+        for field in fields:
+            np.save(os.path.join(self.store_dir, f'{field}_codes.npy'), self.codes[field])
+            with open(os.path.join(self.store_dir, f'{field}_names.json'), 'w', encoding='utf-8') as f:
+                json.dump(self.names[field], f, ensure_ascii=False)
+        np.save(os.path.join(self.store_dir, 'sentence_offsets.npy'), self.offsets)
+        # Manifest last: a store without one is incomplete
+        with open(os.path.join(self.store_dir, MANIFEST_FILE), 'w') as f:
+            json.dump({
+                'rows': int(self.rows),
+                'dim': int(self.dim),
+                'dtype': self.dtype.name,
+                'text_key': self.text_key,
+                'fields': fields,
+            }, f, indent=2)
+
+
+def save_store(store_dir, embeddings, metadata, dtype='float32'):
+    """Write embeddings and a list of per-sentence metadata dicts as a store directory."""
+    embeddings = np.asarray(embeddings)
+    writer = StoreWriter(store_dir, len(metadata), embeddings.shape[1] if embeddings.ndim == 2 else 0, dtype)
+    writer.append(embeddings, metadata)
+    writer.close()
+
+
+class StoreMetadata:
+    """Read-only list-like view that rebuilds the original metadata dict for a row."""
+
+    def __init__(self, store):
+        self._store = store
+
+    def __len__(self):
+        return len(self._store)
+
+    def __getitem__(self, i):
+        return self._store.row(int(i))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._store.row(i)
+
+
+class EmbeddingStore:
+    def __init__(self, store_dir):
+        with open(os.path.join(store_dir, MANIFEST_FILE)) as f:
+            self.manifest = json.load(f)
+        self.store_dir = store_dir
+        self.text_key = self.manifest['text_key']
+        self.fields = self.manifest['fields']
+
+        self.embeddings = np.load(os.path.join(store_dir, 'embeddings.npy'), mmap_mode='r')
+        self.codes = {}
+        self.names = {}
+        for field in self.fields:
+            self.codes[field] = np.load(os.path.join(store_dir, f'{field}_codes.npy'), mmap_mode='r')
+            with open(os.path.join(store_dir, f'{field}_names.json'), encoding='utf-8') as f:
+                self.names[field] = json.load(f)
+        self.sentence_offsets = np.load(os.path.join(store_dir, 'sentence_offsets.npy'), mmap_mode='r')
+        sentences_path = os.path.join(store_dir, 'sentences.bin')
+        if os.path.getsize(sentences_path) > 0:
+            self._sentences = np.memmap(sentences_path, dtype='uint8', mode='r')
+        else:
+            self._sentences = np.zeros(0, dtype='uint8')
+        self.metadata = StoreMetadata(self)
+
+    def __len__(self):
+        return self.manifest['rows']
+
+    def vectors(self, kind=None):
+        """(matrix, scale) for 'float16'/'int8' copies; the full matrix for None/'float32'."""
+        if kind in (None, 'float32', self.manifest['dtype']):
+            return self.embeddings, None
+        if kind not in self.manifest.get('quantized', []):
+            raise ValueError(f"Store {self.store_dir} has no '{kind}' copy (see write_quantized)")
+        matrix = np.load(os.path.join(self.store_dir, f'embeddings_{kind}.npy'), mmap_mode='r')
+        scale = np.load(os.path.join(self.store_dir, 'int8_scale.npy')) if kind == 'int8' else None
+        return matrix, scale
+
+    def rescore(self, query_vecs, rows):
+        """Exact inner products of (q x dim) queries with the given rows (full precision, read lazily)."""
+        rows = np.asarray(rows)
+        order = np.argsort(rows)
+        exact = np.asarray(self.embeddings[rows[order]], dtype='float32')  # sorted reads page in less
+        scores = np.empty((len(query_vecs), len(rows)), dtype='float32')
+        scores[:, order] = np.asarray(query_vecs, dtype='float32') @ exact.T
+        return scores
+
+    def sentence(self, i):
+        start, end = self.sentence_offsets[i], self.sentence_offsets[i + 1]
+        return self._sentences[start:end].tobytes().decode('utf-8')
+
+    def value(self, field, i):
+        code = self.codes[field][i]
+        return self.names[field][code] if code >= 0 else None
+
+    def rows_where(self, field, value):
+        """Rows whose categorical `field` equals `value`."""
+        if field not in self.names or value not in self.names[field]:
+            return np.zeros(0, dtype='int64')
+        return np.flatnonzero(np.asarray(self.codes[field]) == self.names[field].index(value)).astype('int64')
+
+    def row(self, i):
+        meta = {}
+        for field in self.fields:
+            value = self.value(field, i)
+            if value is not None:
+                meta[field] = value
+        if self.text_key:
+            meta[self.text_key] = self.sentence(i)
+        return meta
+
+
+def read_updates(store_dir):
+    path = os.path.join(store_dir, UPDATES_LOG)
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding='utf-8') as f:
+        # A torn last line (crash mid-append) is ignored
+        entries = []
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                break
+        return entries
+
+
+def append_update(store_dir, entry):
+    with open(os.path.join(store_dir, UPDATES_LOG), 'a', encoding='utf-8') as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def add_segment(store_dir, embeddings, metadata, title=None):
+    """Write rows as a new segment of a store and log them. Returns their global ids."""
+    first_id = len(load_store(store_dir))
+    segment = f'seg_{len([e for e in read_updates(store_dir) if e["op"] == "add"]):05d}'
+    save_store(os.path.join(store_dir, SEGMENTS_DIR, segment), embeddings, metadata,
+               dtype=EmbeddingStore(store_dir).manifest['dtype'])
+    # Logged only once the segment is complete: readers never see a partial one
+    append_update(store_dir, {'op': 'add', 'segment': segment, 'first_id': first_id,
+                              'rows': len(metadata), 'title': title, 'time': time.time()})
+    return np.arange(first_id, first_id + len(metadata), dtype='int64')
+
+
+class SegmentedStore:
+    """Read-only view over a base store and the segments appended by add_segment.
+
+    Ids are global: base rows first, then each segment's rows in log order. Rows of
+    removed titles stay resolvable (the indexes no longer return them) until the
+    store is rewritten with compact_store.
+
+    Per-row access (rescore, sentence, row, metadata) is all the query side needs.
+    Whole-corpus views (embeddings, vectors, codes, names) raise instead: they would
+    miss the segments and still count removed titles, so index building, dedup and
+    the analysis need a compacted store.
+    """
+
+    def __init__(self, store_dir, updates):
+        self.store_dir = store_dir
+        self.base = EmbeddingStore(store_dir)
+        self.manifest = self.base.manifest
+        self.text_key = self.base.text_key
+        self.fields = self.base.fields
+        self.parts = [self.base]
+        self.first_ids = [0]
+        self.removed = {}  # title -> rows below this id were removed (a title may be re-added later)
+        self._rows = len(self.base)
+        for entry in updates:
+            if entry['op'] == 'add':
+                self.parts.append(EmbeddingStore(os.path.join(store_dir, SEGMENTS_DIR, entry['segment'])))
+                self.first_ids.append(entry['first_id'])
+                self._rows = entry['first_id'] + entry['rows']
+            elif entry['op'] == 'remove':
+                self.removed[entry['title']] = self._rows
+        self.metadata = StoreMetadata(self)
+
+    def __len__(self):
+        return self._rows
+
+    def _compact_first(self):
+        return ValueError(f"Store {self.store_dir} has incremental updates ({UPDATES_LOG}); run "
+                          f"'python embedding_store.py compact {self.store_dir} <out_dir>' first")
+
+    @property
+    def embeddings(self):
+        raise self._compact_first()
+
+    @property
+    def codes(self):
+        raise self._compact_first()
+
+    @property
+    def names(self):
+        raise self._compact_first()
+
+    def vectors(self, kind=None):
+        raise self._compact_first()
+
+    def _locate(self, i):
+        part = int(np.searchsorted(self.first_ids, i, side='right')) - 1
+        return self.parts[part], int(i) - self.first_ids[part]
+
+    def rescore(self, query_vecs, rows):
+        rows = np.asarray(rows)
+        scores = np.empty((len(query_vecs), len(rows)), dtype='float32')
+        parts = np.searchsorted(self.first_ids, rows, side='right') - 1
+        for part in np.unique(parts):
+            sel = np.flatnonzero(parts == part)
+            scores[:, sel] = self.parts[part].rescore(query_vecs, rows[sel] - self.first_ids[part])
+        return scores
+
+    def sentence(self, i):
+        part, local = self._locate(i)
+        return part.sentence(local)
+
+    def value(self, field, i):
+        part, local = self._locate(i)
+        return part.value(field, local) if field in part.codes else None
+
+    def rows_where(self, field, value):
+        return np.concatenate([part.rows_where(field, value) + first
+                               for part, first in zip(self.parts, self.first_ids)])
+
+    def row(self, i):
+        part, local = self._locate(i)
+        return part.row(local)
+
+    def is_removed(self, i):
+        title = self.value('title', i)
+        return title in self.removed and i < self.removed[title]
+
+
+def load_store(store_dir):
+    updates = read_updates(store_dir)
+    if updates:
+        return SegmentedStore(store_dir, updates)
+    return EmbeddingStore(store_dir)
+
+
+def compact_store(store_dir, out_dir, dtype='float32', quantized=QUANTIZED_KINDS):
+    """Rewrite a segmented store as one plain store without the removed titles (ids change)."""
+    store = load_store(store_dir)
+    parts = store.parts if isinstance(store, SegmentedStore) else [store]
+    first_ids = store.first_ids if isinstance(store, SegmentedStore) else [0]
+    if isinstance(store, SegmentedStore) and store.removed:
+        keep = [np.array([not store.is_removed(first + i) for i in range(len(part))], dtype=bool)
+                for part, first in zip(parts, first_ids)]
+    else:
+        keep = [np.ones(len(part), dtype=bool) for part in parts]
+    writer = StoreWriter(out_dir, int(sum(k.sum() for k in keep)), parts[0].manifest['dim'], dtype)
+    for part, mask in zip(parts, keep):
+        for start in range(0, len(part), CHUNK_ROWS):
+            rows = np.flatnonzero(mask[start:start + CHUNK_ROWS]) + start
+            writer.append(part.embeddings[rows], [part.row(i) for i in rows])
+    writer.close()
+    for kind in quantized:
+        write_quantized(out_dir, kind)
+
+
+def convert_npz(npz_path, store_dir, dtype='float32', quantized=QUANTIZED_KINDS):
+    """One-off conversion of a legacy *_embeddings_merged.npz into a store directory."""
+    data = np.load(npz_path, allow_pickle=True)
+    save_store(store_dir, data['embeddings'], list(data['metadata']), dtype=dtype)
+    for kind in quantized:
+        write_quantized(store_dir, kind)
+
+
+if __name__ == '__main__':
+    # python embedding_store.py philosophy_embeddings_merged.npz philosophy_store [float16]
+    # python embedding_store.py compact philosophy_store philosophy_store_compact [float16]
+    if sys.argv[1] == 'compact':
+        compact_store(sys.argv[2], sys.argv[3], *sys.argv[4:5])
+        print(f"Compacted {sys.argv[2]} -> {sys.argv[3]}/")
+    else:
+        convert_npz(sys.argv[1], sys.argv[2], *sys.argv[3:4])
+        print(f"Converted {sys.argv[1]} -> {sys.argv[2]}/")
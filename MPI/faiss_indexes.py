@@ -0,0 +1,71 @@
+import numpy as np
+import faiss
+
+# Index types understood by build_index()
+INDEX_TYPES = ('flat', 'sq_fp16', 'sq8', 'ivf_flat', 'ivf_pq', 'hnsw')
+
+
+def default_nlist(n):
+    # Usual rule of thumb: ~4 * sqrt(N) inverted lists
+    return max(1, int(4 * np.sqrt(n)))
+
+
+def build_index(embeddings, index_type='flat', rows=None, nlist=None, nprobe=16, pq_m=64,
+                hnsw_m=32, ef_construction=200, ef_search=128, train_size=100_000, seed=0):
+    """Build (and train, if needed) an empty inner-product index of the requested type.
+
+    `rows` restricts the index to a subset of `embeddings` (e.g. one school of a
+    memory-mapped corpus) without copying it. Quantizers are trained on a random
+    sample of at most `train_size` of those rows. Corpora too small to train an IVF
+    quantizer (a few hundred rows) fall back to a flat index so every school still
+    gets a valid index. Vectors are not added; callers add them (with ids) afterwards.
+    """
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type '{index_type}', expected one of {INDEX_TYPES}")
+
+    dim = embeddings.shape[1]
+    rows = np.arange(len(embeddings)) if rows is None else np.asarray(rows)
+    n = len(rows)
+
+    if index_type in ('sq_fp16', 'sq8'):
+        # Exhaustive like 'flat' but with 2x / 4x smaller float16 / int8 codes
+        qtype = faiss.ScalarQuantizer.QT_fp16 if index_type == 'sq_fp16' else faiss.ScalarQuantizer.QT_8bit
+        index = faiss.IndexScalarQuantizer(dim, qtype, faiss.METRIC_INNER_PRODUCT)
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rows[rng.choice(n, size=min(n, train_size), replace=False)])
+        index.train(np.ascontiguousarray(embeddings[sample], dtype='float32'))
+        return index
+
+    if index_type == 'hnsw':
+        index = faiss.IndexHNSWFlat(dim, hnsw_m, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = ef_construction
+        index.hnsw.efSearch = ef_search
+        return index
+
+    if index_type in ('ivf_flat', 'ivf_pq'):
+        # k-means wants ~39 training points per list; shrink nlist for small schools
+        nlist = min(nlist or default_nlist(n), n // 39)
+        if nlist >= 1 and (index_type == 'ivf_flat' or n >= 256):
+            quantizer = faiss.IndexFlatIP(dim)
+            if index_type == 'ivf_flat':
+                index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
+            else:
+                index = faiss.IndexIVFPQ(quantizer, dim, nlist, pq_m, 8, faiss.METRIC_INNER_PRODUCT)
+            rng = np.random.default_rng(seed)
+            sample = np.sort(rows[rng.choice(n, size=min(n, train_size), replace=False)])
+            index.train(np.ascontiguousarray(embeddings[sample], dtype='float32'))
+            index.nprobe = nprobe
+            return index
+
+    return faiss.IndexFlatIP(dim)
+
+
+def set_search_param(index, value):
+    """Set the speed/recall knob of an index: nprobe for IVF, efSearch for HNSW."""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = value
+        return
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    if isinstance(inner, faiss.IndexHNSW):
+        inner.hnsw.efSearch = value
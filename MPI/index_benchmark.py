@@ -0,0 +1,78 @@
+import time
+import numpy as np
+import pandas as pd
+import faiss
+from faiss_indexes import build_index, set_search_param
+from embedding_store import load_store
+
+# Recall-vs-latency report for the index types supported by merge_embeddings.py.
+# A random sample of the merged corpus is held out as queries; every candidate
+# index is built on the remaining rows and compared against the exact flat index.
+
+STORE_DIR = 'philosophy_store' # or religion_store
+REPORT_FILE = 'index_benchmark_report.csv'
+N_QUERIES = 1000
+K = 10
+SEED = 0
+
+# (index_type, build kwargs, search-time knob values: nprobe for IVF, efSearch for HNSW)
+CONFIGS = [
+    ('sq_fp16', {}, [None]),
+    ('sq8', {}, [None]),
+    ('ivf_flat', {}, [1, 4, 16, 64]),
+    ('ivf_pq', {'pq_m': 64}, [4, 16, 64]),
+    ('ivf_pq', {'pq_m': 128}, [4, 16, 64]),
+    ('hnsw', {'hnsw_m': 32}, [16, 64, 128, 256]),
+]
+
+
+def time_search(index, queries, k):
+    # One query at a time, like the app does
+    start = time.perf_counter()
+    I = np.empty((len(queries), k), dtype='int64')
+    for i in range(len(queries)):
+        _, I[i:i + 1] = index.search(queries[i:i + 1], k)
+    elapsed = time.perf_counter() - start
+    return I, elapsed / len(queries) * 1000
+
+
+def recall_at_k(I, I_true):
+    hits = sum(len(np.intersect1d(row, row_true)) for row, row_true in zip(I, I_true))
+    return hits / I_true.size
+
+
+embeddings = np.array(load_store(STORE_DIR).embeddings, dtype='float32')
+faiss.normalize_L2(embeddings)
+
+rng = np.random.default_rng(SEED)
+query_mask = np.zeros(len(embeddings), dtype=bool)
+query_mask[rng.choice(len(embeddings), size=N_QUERIES, replace=False)] = True
+queries = embeddings[query_mask]
+base = embeddings[~query_mask]
+print(f"Base vectors: {base.shape}, held-out queries: {queries.shape}")
+
+flat = faiss.IndexFlatIP(base.shape[1])
+flat.add(base)
+I_true, flat_ms = time_search(flat, queries, K)
+rows = [{'index_type': 'flat', 'params': '', 'search_param': '', 'build_s': 0.0,
+         f'recall@{K}': 1.0, 'ms_per_query': flat_ms}]
+print(f"flat: {flat_ms:.2f} ms/query")
+
+for index_type, kwargs, search_values in CONFIGS:
+    t0 = time.perf_counter()
+    index = build_index(base, index_type, **kwargs)
+    index.add(base)
+    build_s = time.perf_counter() - t0
+    for value in search_values:
+        if value is not None:
+            set_search_param(index, value)
+        I, ms = time_search(index, queries, K)
+        recall = recall_at_k(I, I_true)
+        rows.append({'index_type': index_type, 'params': str(kwargs), 'search_param': value,
+                     'build_s': build_s, f'recall@{K}': recall, 'ms_per_query': ms})
+        print(f"{index_type} {kwargs} param={value}: recall@{K}={recall:.3f}, {ms:.2f} ms/query")
+
+report = pd.DataFrame(rows)
+report.to_csv(REPORT_FILE, index=False)
+print(f"\nReport saved to {REPORT_FILE}")
+print(report.to_string(index=False))
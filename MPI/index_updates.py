@@ -0,0 +1,189 @@
+import os
+import sys
+import shutil
+import numpy as np
+import faiss
+from faiss_indexes import build_index
+from embedding_store import EmbeddingStore, SEGMENTS_DIR, load_store, add_segment, append_update, read_updates
+from merge_embeddings import INDEX_TYPE, NPROBE, EF_SEARCH
+
+# Add or remove a title without re-embedding the corpus or rebuilding every index.
+#
+# The per-school indexes are IndexIDMaps whose ids are global store rows, so new
+# rows (a store segment, see embedding_store.add_segment) are added with their ids
+# and a removed title's ids are dropped with remove_ids. Each update is published
+# as a new version directory next to the previous ones:
+#
+#   philosophy_school_indexes/v00003/<school>.index
+#   philosophy_school_indexes/CURRENT          -> "v00003"
+#
+# Unchanged schools are hard links to the previous version, and CURRENT is
+# replaced atomically, so a reader (philo_qa.py) sees either the old or the new
+# set of indexes, never a mix. The plain layout written by merge_embeddings.py
+# (index files directly in the directory) counts as the initial version.
+#
+#   python index_updates.py add new_book.csv
+#   python index_updates.py remove "Title Of The Book"
+
+STORE_DIR = 'philosophy_store'
+SCHOOL_INDEX_DIR = 'philosophy_school_indexes'
+MODEL_NAME = 'intfloat/e5-large-v2'  # must match embed_mpi.py
+PREFIX = 'passage: '
+TEXT_COLUMN = 'sentence_str'
+METADATA_COLUMNS = ['title', 'author', 'school', 'sentence_str']
+KEEP_VERSIONS = 3  # older versions are deleted (readers may still be loading the previous one)
+CURRENT_FILE = 'CURRENT'
+
+
+def current_version(index_dir):
+    # (version name or None for the plain layout, directory holding the .index files)
+    path = os.path.join(index_dir, CURRENT_FILE)
+    if not os.path.exists(path):
+        return None, index_dir
+    with open(path) as f:
+        version = f.read().strip()
+    return version, os.path.join(index_dir, version)
+
+
+def load_school_indexes(index_dir):
+    _, version_dir = current_version(index_dir)
+    return {fname[:-len('.index')]: os.path.join(version_dir, fname)
+            for fname in sorted(os.listdir(version_dir)) if fname.endswith('.index')}
+
+
+def publish(index_dir, changed):
+    """Write a new version with `changed` {school: index or None (= drop)}; flip CURRENT."""
+    previous = load_school_indexes(index_dir)
+    versions = sorted(d for d in os.listdir(index_dir) if d.startswith('v') and os.path.isdir(os.path.join(index_dir, d)))
+    version = f'v{int(versions[-1][1:]) + 1 if versions else 1:05d}'
+    version_dir = os.path.join(index_dir, version)
+    os.makedirs(version_dir)
+
+    for school, path in previous.items():
+        if school not in changed:
+            target = os.path.join(version_dir, f'{school}.index')
+            try:
+                os.link(path, target)
+            except OSError:
+                shutil.copy2(path, target)
+    for school, index in changed.items():
+        if index is not None:
+            faiss.write_index(index, os.path.join(version_dir, f'{school}.index'))
+
+    tmp = os.path.join(index_dir, CURRENT_FILE + '.tmp')
+    with open(tmp, 'w') as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, os.path.join(index_dir, CURRENT_FILE))
+
+    for old in versions[:max(len(versions) + 1 - KEEP_VERSIONS, 0)]:
+        shutil.rmtree(os.path.join(index_dir, old), ignore_errors=True)
+    print(f"Published {version} ({len(changed)} school indexes changed)")
+    return version
+
+
+def live_rows(store, title):
+    # Ids of `title` that have not been removed since they were added
+    ids = store.rows_where('title', title)
+    if hasattr(store, 'is_removed'):
+        ids = np.array([i for i in ids if not store.is_removed(i)], dtype='int64')
+    return ids
+
+
+def unpublished_add(title, store_dir, index_dir):
+    # (ids, embeddings, metadata) of the last logged segment of `title` when none of
+    # its ids made it into the published indexes (a crash between add_segment and
+    # publish), else None
+    adds = [e for e in read_updates(store_dir) if e['op'] == 'add' and e.get('title') == title]
+    if not adds:
+        return None  # the title is in the base store
+    entry = adds[-1]
+    ids = np.arange(entry['first_id'], entry['first_id'] + entry['rows'], dtype='int64')
+    segment = EmbeddingStore(os.path.join(store_dir, SEGMENTS_DIR, entry['segment']))
+    metadata = list(segment.metadata)
+    paths = load_school_indexes(index_dir)
+    for school in {str(m.get('school', 'Unknown')) for m in metadata}:
+        if school in paths:
+            index = faiss.read_index(paths[school])  # keep a reference while its id_map is read
+            if np.isin(faiss.vector_to_array(index.id_map), ids).any():
+                return None
+    return ids, np.asarray(segment.embeddings, dtype='float32'), metadata
+
+
+def add_title(embeddings, metadata, store_dir=STORE_DIR, index_dir=SCHOOL_INDEX_DIR):
+    """Append L2-normalized embeddings + metadata dicts (one title) and index them."""
+    embeddings = np.asarray(embeddings, dtype='float32')
+    titles = {m.get('title') for m in metadata}
+    if len(titles) != 1:
+        raise ValueError(f"add_title expects the rows of one title, got {sorted(map(str, titles))}")
+    title = titles.pop()
+    store = load_store(store_dir)
+    if len(live_rows(store, title)):
+        pending = unpublished_add(title, store_dir, index_dir)
+        if pending is None:
+            raise ValueError(f"'{title}' is already in {store_dir}; remove it first to replace it")
+        # Logged but never published: index the stored rows instead of refusing
+        print(f"Finishing the interrupted add of '{title}'")
+        ids, embeddings, metadata = pending
+    else:
+        # Store first, indexes last: a crash in between leaves rows no index returns,
+        # which the branch above picks up on the next add of the title
+        ids = add_segment(store_dir, embeddings, metadata, title)
+    paths = load_school_indexes(index_dir)
+    schools = np.array([str(m.get('school', 'Unknown')) for m in metadata])
+    changed = {}
+    for school in np.unique(schools):
+        sel = np.flatnonzero(schools == school)
+        if school in paths:
+            index = faiss.read_index(paths[school])
+        else:
+            index = faiss.IndexIDMap(build_index(embeddings, INDEX_TYPE, rows=sel, nprobe=NPROBE, ef_search=EF_SEARCH))
+        index.add_with_ids(embeddings[sel], ids[sel])
+        changed[school] = index
+        print(f"  {school}: +{len(sel)} vectors")
+    return publish(index_dir, changed)
+
+
+def remove_title(title, store_dir=STORE_DIR, index_dir=SCHOOL_INDEX_DIR):
+    """Drop every row of `title` from the per-school indexes (the store keeps them until compaction)."""
+    ids = live_rows(load_store(store_dir), title)
+    if not len(ids):
+        raise ValueError(f"No rows with title '{title}' in {store_dir}")
+    selector = faiss.IDSelectorBatch(ids)
+    changed = {}
+    for school, path in load_school_indexes(index_dir).items():
+        index = faiss.read_index(path)
+        try:
+            removed = index.remove_ids(selector)
+        except RuntimeError as e:
+            raise RuntimeError(f"The '{school}' index does not support removal ({e}); "
+                               f"rebuild it with merge_embeddings.py instead") from e
+        if removed:
+            changed[school] = index if index.ntotal else None
+            print(f"  {school}: -{removed} vectors")
+    # Indexes first: after a crash in between, the title is gone from search and a
+    # repeated remove only logs it, rather than the store hiding rows still served
+    version = publish(index_dir, changed)
+    append_update(store_dir, {'op': 'remove', 'title': title})
+    return version
+
+
+def embed_csv(path):
+    # Embed a small CSV of new sentences in-process (same model and prefix as embed_mpi.py)
+    import pandas as pd
+    from sentence_transformers import SentenceTransformer
+    df = pd.read_csv(path, usecols=METADATA_COLUMNS)
+    model = SentenceTransformer(MODEL_NAME)
+    embeddings = model.encode([PREFIX + str(s) for s in df[TEXT_COLUMN]], normalize_embeddings=True)
+    return embeddings, df.to_dict('records')
+
+
+if __name__ == '__main__':
+    command, argument = sys.argv[1], sys.argv[2]
+    if command == 'add':
+        add_title(*embed_csv(argument))
+    elif command == 'remove':
+        remove_title(argument)
+    else:
+        sys.exit(f"Unknown command '{command}', expected 'add' or 'remove'")
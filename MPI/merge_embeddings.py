@@ -1,48 +1,118 @@
 import os
+import shutil
+import zipfile
 import numpy as np
 import faiss
+from faiss_indexes import build_index
+from embedding_store import StoreWriter, load_store, write_quantized
 
 EMBEDDINGS_DIR = './embeddings_output'
+OUTPUT_STORE_DIR = 'philosophy_store' # or religion_store (memory-mappable, see embedding_store.py)
+STORE_DTYPE = 'float32' # precision of the main matrix, used for exact rescoring
+QUANTIZED_COPIES = ['float16', 'int8'] # compact copies for the analysis / low-memory search
 OUTPUT_MERGED_FILE = 'philosophy_embeddings_merged.npz' # or religion_embeddings_merged.npz
-FAISS_INDEX_FILE = 'philosophy_faiss.index' # or religion_faiss.index
+WRITE_LEGACY_NPZ = False # also write the old compressed .npz for external tools (loads the whole corpus in RAM)
+SCHOOL_INDEX_DIR = 'philosophy_school_indexes' # or religion_school_indexes
+INDEX_TYPE = 'flat' # 'flat', 'sq_fp16', 'sq8', 'ivf_flat', 'ivf_pq' or 'hnsw' (see index_benchmark.py / quantization_benchmark.py)
+NPROBE = 16 # IVF lists visited per query
+EF_SEARCH = 128 # HNSW candidate list size per query
+ADD_CHUNK = 65536 # rows added to a FAISS index per call
 
-# Gather all npz files
-files = sorted([f for f in os.listdir(EMBEDDINGS_DIR) if f.startswith('embeddings_rank_') and f.endswith('.npz')])
 
-all_embeddings = []
-all_metadata = []
+def npz_array_shape(path, name):
+    # Read only the .npy header of one member of an .npz, without decompressing the data
+    with zipfile.ZipFile(path) as zf, zf.open(f'{name}.npy') as f:
+        major, _ = np.lib.format.read_magic(f)
+        read_header = np.lib.format.read_array_header_1_0 if major == 1 else np.lib.format.read_array_header_2_0
+        shape, _, _ = read_header(f)
+    return shape
 
-print(f"Loading {len(files)} embedding chunks...")
 
-for file in files:
-    data = np.load(os.path.join(EMBEDDINGS_DIR, file), allow_pickle=True)
-    embeddings = data['embeddings']
-    metadata = data['metadata']
-    all_embeddings.append(embeddings)
-    all_metadata.extend(metadata)
+def add_in_chunks(index, embeddings, rows):
+    # Add a subset of memory-mapped rows without materializing them all
+    for start in range(0, len(rows), ADD_CHUNK):
+        ids = rows[start:start + ADD_CHUNK]
+        index.add_with_ids(np.asarray(embeddings[ids], dtype='float32'), ids)
 
-# Concatenate all embeddings (shape: total_sentences x embedding_dim)
-all_embeddings = np.vstack(all_embeddings).astype('float32')
 
-print(f"Total embeddings shape: {all_embeddings.shape}")
-print(f"Total metadata items: {len(all_metadata)}")
+def merge_shards(embeddings_dir=EMBEDDINGS_DIR, store_dir=OUTPUT_STORE_DIR, exclude_rows=None):
+    # exclude_rows: input row numbers (the shards' 'indices') left out of the store,
+    # e.g. the semantic duplicates found by pipeline.py
+    # Gather all npz files
+    files = sorted([f for f in os.listdir(embeddings_dir) if f.startswith('embeddings_rank_') and f.endswith('.npz')])
+    if not files:
+        raise SystemExit(f"No embeddings_rank_*.npz shards found in {embeddings_dir}; run embed_mpi.py first")
 
-# Save merged embeddings and metadata
-np.savez_compressed(OUTPUT_MERGED_FILE, embeddings=all_embeddings, metadata=all_metadata)
+    print(f"Loading {len(files)} embedding chunks...")
 
-print(f"Merged embeddings and metadata saved to {OUTPUT_MERGED_FILE}")
+    # Pass 1: headers only, to size the output
+    shapes = [npz_array_shape(os.path.join(embeddings_dir, file), 'embeddings') for file in files]
+    dimension = shapes[0][1]
+    keep = {}
+    if exclude_rows is not None and len(exclude_rows):
+        exclude_rows = np.fromiter(exclude_rows, dtype='int64')
+        for file in files:
+            with np.load(os.path.join(embeddings_dir, file)) as data:  # the small 'indices' member only
+                keep[file] = ~np.isin(data['indices'], exclude_rows)
+    total_rows = sum(int(keep[file].sum()) if file in keep else shape[0] for file, shape in zip(files, shapes))
 
-# Build FAISS index for similarity search
-dimension = all_embeddings.shape[1]
-index = faiss.IndexFlatIP(dimension)  # inner product = cosine similarity if vectors normalized
+    # Pass 2: stream shards one by one into the preallocated, memory-mapped store.
+    # Vectors were already L2-normalized by embed_mpi.py, so no re-normalization here.
+    writer = StoreWriter(store_dir, total_rows, dimension, dtype=STORE_DTYPE)
+    for file in files:
+        with np.load(os.path.join(embeddings_dir, file), allow_pickle=True) as data:
+            if file in keep:
+                writer.append(data['embeddings'][keep[file]], list(data['metadata'][keep[file]]))
+            else:
+                writer.append(data['embeddings'], list(data['metadata']))
+    writer.close()
+    for kind in QUANTIZED_COPIES:
+        write_quantized(store_dir, kind)
 
-# Optional: normalize vectors for cosine similarity
-faiss.normalize_L2(all_embeddings)
+    print(f"Total embeddings shape: {(total_rows, dimension)}")
+    print(f"Merged embeddings and metadata saved to {store_dir}/")
 
-print("Adding embeddings to FAISS index...")
-index.add(all_embeddings)
+    if WRITE_LEGACY_NPZ:
+        store = load_store(store_dir)
+        np.savez_compressed(OUTPUT_MERGED_FILE, embeddings=np.asarray(store.embeddings, dtype='float32'),
+                            metadata=list(store.metadata))
+        print(f"Merged embeddings and metadata saved to {OUTPUT_MERGED_FILE}")
 
-faiss.write_index(index, FAISS_INDEX_FILE)
-print(f"FAISS index saved to {FAISS_INDEX_FILE}")
 
-print("All done!")
+def build_indexes(store_dir=OUTPUT_STORE_DIR, school_index_dir=SCHOOL_INDEX_DIR):
+    store = load_store(store_dir)
+    all_embeddings = store.embeddings  # read-only memmap
+
+    # Inner product = cosine similarity since vectors are normalized.
+    # Build one index per school so the app can ask for "top-k of each selected school"
+    # directly instead of over-fetching from one corpus-wide index and filtering afterwards.
+    # Ids are the global row numbers, so hits map straight back into the metadata.
+    school_codes = np.asarray(store.codes['school'])
+    school_names = store.names['school']
+
+    os.makedirs(school_index_dir, exist_ok=True)
+    for code in np.unique(school_codes):
+        school = school_names[code] if code >= 0 else 'Unknown'
+        rows = np.flatnonzero(school_codes == code).astype('int64')
+        school_index = faiss.IndexIDMap(build_index(all_embeddings, INDEX_TYPE, rows=rows, nprobe=NPROBE, ef_search=EF_SEARCH))
+        add_in_chunks(school_index, all_embeddings, rows)
+        # Write then rename: a running app maps the old file and must keep seeing it intact
+        path = os.path.join(school_index_dir, f'{school}.index')
+        faiss.write_index(school_index, path + '.tmp')
+        os.replace(path + '.tmp', path)
+        print(f"  {school}: {len(rows)} vectors")
+
+    # A full rebuild replaces any versions published by index_updates.py
+    if os.path.exists(os.path.join(school_index_dir, 'CURRENT')):
+        os.remove(os.path.join(school_index_dir, 'CURRENT'))
+    for version in os.listdir(school_index_dir):
+        if version.startswith('v') and os.path.isdir(os.path.join(school_index_dir, version)):
+            shutil.rmtree(os.path.join(school_index_dir, version))
+
+    print(f"Per-school FAISS indexes saved to {school_index_dir}/")
+
+
+if __name__ == '__main__':
+    merge_shards()
+    build_indexes()
+    print("All done!")
@@ -0,0 +1,70 @@
+import time
+import numpy as np
+import pandas as pd
+from embedding_store import load_store, dequantize
+
+# Recall report for the compact float16 / int8 copies of a store against the
+# float32 baseline, with and without exact rescoring of the top candidates.
+# Held-out corpus vectors serve as queries; scoring is exhaustive, as in
+# deep_mpi_analysis.py, so the only source of error is the quantization itself.
+
+STORE_DIR = 'philosophy_store' # or religion_store
+REPORT_FILE = 'quantization_report.csv'
+N_QUERIES = 500
+K = 10
+RESCORE_FACTORS = [1, 2, 4, 8]  # 1 = no rescoring
+BLOCK_ROWS = 65536
+SEED = 0
+
+
+def top_k(queries, matrix, kind, scale, k, exclude):
+    # Exhaustive block-wise inner-product search over a (possibly quantized) matrix
+    best_scores = np.full((len(queries), k), -np.inf, dtype='float32')
+    best_rows = np.zeros((len(queries), k), dtype='int64')
+    for start in range(0, len(matrix), BLOCK_ROWS):
+        block = dequantize(matrix[start:start + BLOCK_ROWS], kind, scale)
+        scores = queries @ block.T
+        rows = np.arange(start, start + len(block))
+        scores[:, np.isin(rows, exclude)] = -np.inf  # the held-out queries themselves
+        all_scores = np.hstack([best_scores, scores])
+        all_rows = np.hstack([best_rows, np.broadcast_to(rows, scores.shape)])
+        keep = np.argpartition(-all_scores, k - 1, axis=1)[:, :k]
+        best_scores = np.take_along_axis(all_scores, keep, axis=1)
+        best_rows = np.take_along_axis(all_rows, keep, axis=1)
+    order = np.argsort(-best_scores, axis=1)
+    return np.take_along_axis(best_rows, order, axis=1)
+
+
+def recall_at_k(I, I_true):
+    hits = sum(len(np.intersect1d(row, row_true)) for row, row_true in zip(I, I_true))
+    return hits / I_true.size
+
+
+store = load_store(STORE_DIR)
+rng = np.random.default_rng(SEED)
+query_rows = np.sort(rng.choice(len(store), size=N_QUERIES, replace=False))
+queries = np.asarray(store.embeddings[query_rows], dtype='float32')
+
+t0 = time.perf_counter()
+I_true = top_k(queries, store.embeddings, 'float32', None, K, query_rows)
+rows = [{'precision': 'float32', 'rescore_factor': 1, 'bytes_per_vector': store.embeddings.dtype.itemsize * store.embeddings.shape[1],
+         f'recall@{K}': 1.0, 'seconds': time.perf_counter() - t0}]
+
+for kind in store.manifest.get('quantized', []):
+    matrix, scale = store.vectors(kind)
+    for factor in RESCORE_FACTORS:
+        t0 = time.perf_counter()
+        candidates = top_k(queries, matrix, kind, scale, K * factor, query_rows)
+        if factor > 1:
+            exact = np.stack([store.rescore(q[None, :], c)[0] for q, c in zip(queries, candidates)])
+            candidates = np.take_along_axis(candidates, np.argsort(-exact, axis=1), axis=1)
+        I = candidates[:, :K]
+        recall = recall_at_k(I, I_true)
+        rows.append({'precision': kind, 'rescore_factor': factor, 'bytes_per_vector': matrix.dtype.itemsize * matrix.shape[1],
+                     f'recall@{K}': recall, 'seconds': time.perf_counter() - t0})
+        print(f"{kind} rescore x{factor}: recall@{K}={recall:.4f}")
+
+report = pd.DataFrame(rows)
+report.to_csv(REPORT_FILE, index=False)
+print(f"\nReport saved to {REPORT_FILE}")
+print(report.to_string(index=False))
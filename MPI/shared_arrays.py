@@ -0,0 +1,74 @@
+import numpy as np
+from mpi4py import MPI
+
+# Distribute read-only numpy arrays from one rank to all ranks without pickling.
+#
+# share_array gives every rank its own copy through buffer-based Bcast (small
+# arrays such as the query vectors); scatter_rows gives each rank only its own
+# contiguous shard of rows (the corpus).
+
+BCAST_CHUNK_BYTES = 1 << 30  # stay well below MPI's 2**31 element count limit
+ROUND_BYTES = 1 << 28  # rows sent per Bcast / Scatterv round, so root never copies a whole memmap into RAM
+
+
+def _bcast_buffer(comm, buf, root):
+    flat = buf.reshape(-1).view('uint8')
+    for start in range(0, flat.size, BCAST_CHUNK_BYTES):
+        comm.Bcast([flat[start:start + BCAST_CHUNK_BYTES], MPI.BYTE], root=root)
+
+
+def _rows_per_round(row_bytes, ranks=1):
+    return max(1, ROUND_BYTES // max(row_bytes * ranks, 1))
+
+
+def share_array(arr, comm=MPI.COMM_WORLD, root=0):
+    """
+    Return `arr` (given on `root`, None elsewhere; may be a memmap) on every rank of
+    `comm`. Rows go out in rounds of at most ROUND_BYTES, so root only ever holds
+    one round of a memory-mapped array in RAM.
+    """
+    rank = comm.Get_rank()
+    header = (arr.shape, arr.dtype.str) if rank == root else None
+    shape, dtype = comm.bcast(header, root=root)  # tiny: shape + dtype only
+    dtype = np.dtype(dtype)
+    out = arr if rank == root else np.empty(shape, dtype=dtype)
+    if out.nbytes:
+        step = _rows_per_round(out.nbytes // len(out))
+        for start in range(0, len(out), step):
+            block = out[start:start + step]
+            _bcast_buffer(comm, np.ascontiguousarray(block) if rank == root else block, root)
+    return out
+
+
+def scatter_rows(arr, comm=MPI.COMM_WORLD, root=0):
+    """
+    Split the rows of `arr` (given on `root`, None elsewhere; may be a memmap) into
+    contiguous shards, one per rank, with Scatterv in rounds of at most ROUND_BYTES.
+    Returns (shard, first_row, total_rows); no rank holds more than its own shard,
+    plus one round's send buffer on root.
+    """
+    rank, size = comm.Get_rank(), comm.Get_size()
+    header = (arr.shape, arr.dtype.str) if rank == root else None
+    shape, dtype = comm.bcast(header, root=root)
+    dtype = np.dtype(dtype)
+    n, row_shape = shape[0], tuple(shape[1:])
+    bounds = np.linspace(0, n, size + 1).astype('int64')
+    counts = np.diff(bounds)
+    shard = np.empty((counts[rank],) + row_shape, dtype=dtype)
+
+    # One datatype element per row keeps counts far below the 2**31 limit
+    row_bytes = int(np.prod(row_shape, dtype='int64')) * dtype.itemsize
+    if n and row_bytes:
+        row_type = MPI.BYTE.Create_contiguous(row_bytes).Commit()
+        step = _rows_per_round(row_bytes, size)
+        for offset in range(0, int(counts.max()), step):
+            # This round: rows [offset, offset + step) of every rank's shard
+            part = np.clip(counts - offset, 0, step)
+            send = None
+            if rank == root:
+                buf = np.concatenate([np.asarray(arr[lo + offset:lo + offset + p])
+                                      for lo, p in zip(bounds[:-1], part)])
+                send = [buf, part, np.concatenate([[0], np.cumsum(part)[:-1]]), row_type]
+            comm.Scatterv(send, [shard[offset:offset + part[rank]], row_type], root=root)
+        row_type.Free()
+    return shard, int(bounds[rank]), n
@@ -1,6 +1,16 @@
 import pandas as pd
+import numpy as np
+import os
 import re
+import glob
+import json
+import time
+import codecs
+import hashlib
+import inspect
+import multiprocessing
 import spacy
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Set, Dict
 from nltk.tokenize import word_tokenize, sent_tokenize
 import nltk
@@ -21,6 +31,120 @@ try:
 except LookupError:
     nltk.download('stopwords')
 
+def _trie_pattern(words) -> str:
+    """Regex matching any of `words`, with common prefixes factored out."""
+    trie = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[''] = {}  # end of word
+
+    def build(node):
+        branches = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ''
+        pattern = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        # A word may end here; the rest is optional (only existence matters)
+        return f'(?:{pattern})?' if '' in node else pattern
+
+    return build(trie)
+
+# spaCy batching for the NER stage; N_PROCESS worker processes (one per core)
+BATCH_SIZE = 1000
+N_PROCESS = os.cpu_count() or 1
+CHUNK_ROWS = 50_000  # rows per chunk in streaming mode; None loads the whole file at once
+ENCODINGS = ['utf-8', 'latin-1', 'iso-8859-1', 'cp1252', 'utf-16']
+DECISION_CACHE_DIR = 'decision_cache'  # persistent decisions, keyed on text hash + rule fingerprint; None disables
+RULES_VERSION = 1  # bump to invalidate cached decisions after a rule change the fingerprint cannot see
+
+def detect_encoding(path: str, encodings=ENCODINGS, sample_bytes: int = 1 << 20) -> str:
+    """First encoding that decodes a sample from the start of the file."""
+    with open(path, 'rb') as f:
+        sample = f.read(sample_bytes)
+    for encoding in encodings:
+        try:
+            # Incremental decoder: a multi-byte character cut at the sample end is not an error
+            codecs.getincrementaldecoder(encoding)().decode(sample, final=False)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+    raise UnicodeDecodeError('unknown', sample[:1], 0, 1, f"none of {encodings} decodes {path}")
+
+def text_key(text) -> bytes:
+    """Cache key of a sentence: md5 of the stripped text (all rules see text.strip())."""
+    return hashlib.md5(text.strip().encode('utf-8')).hexdigest().encode('ascii')
+
+class DecisionCache:
+    """
+    Persistent decisions per rule fingerprint, in append-only segments
+    (<stage>_<fingerprint>_<run>.npz) so a crash never loses earlier runs.
+
+    Two stages are cached: 'full' decisions (valid while every rule is unchanged)
+    and 'ner' decisions of the spaCy stage (valid while only the NER rules are
+    unchanged, so tuning a keyword or length rule re-runs just the cheap checks).
+    """
+
+    MAX_SEGMENTS = 16  # compact a stage's segments into one beyond this
+
+    def __init__(self, cache_dir: str, fingerprints: Dict[str, str]):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.fingerprints = fingerprints
+        self.run_id = f'{int(time.time() * 1000):x}'
+        self.entries = {stage: {} for stage in fingerprints}
+        self.new_entries = {stage: {} for stage in fingerprints}
+        self.hits = 0
+        self.saves = 0  # segment number within this run (names stay unique after compaction)
+        for stage, fingerprint in fingerprints.items():
+            segments = sorted(glob.glob(os.path.join(cache_dir, f'{stage}_{fingerprint}_*.npz')))
+            for path in segments:
+                with np.load(path) as data:
+                    self.entries[stage].update(zip(data['keys'].tolist(), zip(data['keep'].tolist(), data['reason'].tolist())))
+            self._compact_if_needed(stage)
+
+    def get(self, stage: str, key: bytes):
+        entry = self.entries[stage].get(key)
+        if entry is None:
+            return None
+        self.hits += 1
+        return {'keep': entry[0], 'reason': entry[1]}
+
+    def put(self, stage: str, key: bytes, decision: Dict[str, any]):
+        if decision['reason'] == 'error_default_keep':
+            return  # not a rule outcome
+        entry = (bool(decision['keep']), decision['reason'])
+        self.entries[stage][key] = entry
+        self.new_entries[stage][key] = entry
+
+    def _write(self, stage: str, entries, tag: str) -> str:
+        path = os.path.join(self.cache_dir, f'{stage}_{self.fingerprints[stage]}_{self.run_id}_{tag}.npz')
+        keys = np.array(list(entries.keys()), dtype='S32')
+        keep = np.array([e[0] for e in entries.values()], dtype=bool)
+        reason = np.array([e[1] for e in entries.values()], dtype=str)
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, keys=keys, keep=keep, reason=reason)
+        os.replace(path + '.tmp', path)
+        return path
+
+    def _compact_if_needed(self, stage: str):
+        # All of a stage's entries are in memory: write them as one segment, then drop the rest
+        segments = glob.glob(os.path.join(self.cache_dir, f'{stage}_{self.fingerprints[stage]}_*.npz'))
+        if len(segments) > self.MAX_SEGMENTS:
+            compact = self._write(stage, self.entries[stage], 'compact')
+            for path in segments:
+                if path != compact:
+                    os.remove(path)
+
+    def save(self):
+        """Write the decisions added since the last save as a new segment (compacting past MAX_SEGMENTS)."""
+        for stage, entries in self.new_entries.items():
+            if entries:
+                self._write(stage, entries, f'{self.saves:05d}')
+                self.new_entries[stage] = {}
+                self._compact_if_needed(stage)
+        self.saves += 1
+
 class AdvancedReligiousTextCleaner:
     def __init__(self):
         """Initialize the cleaner with comprehensive philosophical and religious keywords."""
@@ -101,56 +225,141 @@ class AdvancedReligiousTextCleaner:
             'Father', 'Son', 'Spirit', 'Holy', 'Sacred', 'Divine', 'Eternal',
             'Heaven', 'Earth', 'Creation', 'Creator', 'Almighty', 'Supreme'
         }
+        
+        # Meaningful verbs that indicate teaching or action
+        self.meaningful_verbs = {
+            'teaches', 'reveals', 'declares', 'proclaims', 'speaks', 'says',
+            'commands', 'instructs', 'guides', 'leads', 'shows', 'demonstrates',
+            'manifests', 'embodies', 'represents', 'symbolizes', 'signifies',
+            'means', 'indicates', 'suggests', 'implies', 'conveys'
+        }
+        
+        # Important short phrases
+        self.valuable_patterns = [
+            r'\bi am\b.*\bthat\b',  # "I am that I am" type statements
+            r'\bthou art\b',        # "Thou art that"
+            r'\bknow.*truth\b',     # Know the truth
+            r'\blive.*peace\b',     # Live in peace
+            r'\blove.*neighbor\b',  # Love thy neighbor
+            r'\bseek.*find\b',      # Seek and find
+            r'\bask.*given\b',      # Ask and it shall be given
+            r'\bblessed.*\b',       # Blessed are...
+            r'\breturn.*lord\b',    # Return to the Lord
+            r'\bpure.*heart\b',     # Pure in heart
+        ]
+        
+        # Thresholds
+        self.min_chars = 3  # shorter sentences are dropped outright
+        self.min_words = 4  # fewer words must match a valuable pattern
+        self.min_unique_ratio = 0.3  # fewer unique words = repetitive text
+        self.capital_ratio_threshold = 0.5
+        self.name_ratio_threshold = 0.6  # share of name tokens for is_mostly_names
+        
+        self.decision_cache = None
+        self.ner_pool = None  # see ner_worker_pool
+        self.compile_matchers()
+
+    def rule_fingerprints(self) -> Dict[str, str]:
+        """
+        Hashes of everything a decision depends on: keyword sets, patterns,
+        thresholds, the spaCy model, RULES_VERSION and the source of the code
+        that turns them into decisions (rule methods, matcher compilation, cache
+        keys). 'ner' covers only what the spaCy stage uses; 'full' covers all rules.
+        """
+        def digest(parts):
+            return hashlib.md5(json.dumps(parts, sort_keys=True, default=sorted).encode('utf-8')).hexdigest()[:16]
+        def sources(*methods):
+            return [inspect.getsource(getattr(type(self), m)) for m in methods]
+        
+        spacy_model = [spacy.__version__, self.nlp.meta.get('name'), self.nlp.meta.get('version')] if self.nlp else None
+        shared = [RULES_VERSION, inspect.getsource(text_key)]
+        ner = digest({
+            'shared': shared,
+            'name_whitelist': self.name_whitelist,
+            'religious_protected_terms': self.religious_protected_terms,
+            'capital_ratio_threshold': self.capital_ratio_threshold,
+            'name_ratio_threshold': self.name_ratio_threshold,
+            'spacy': spacy_model,
+            'code': sources('_ner_decision', 'calculate_capital_ratio', 'is_mostly_names', '_load_spacy_model'),
+        })
+        full = digest({
+            'ner': ner,
+            'philosophical_keywords': self.philosophical_keywords,
+            'meaningful_verbs': self.meaningful_verbs,
+            'genealogy_patterns': self.genealogy_patterns,
+            'valuable_patterns': self.valuable_patterns,
+            'min_chars': self.min_chars,
+            'min_words': self.min_words,
+            'min_unique_ratio': self.min_unique_ratio,
+            'code': sources('_cheap_decision', 'is_genealogical_text', 'contains_meaningful_content',
+                            'has_meaningful_length', 'is_valuable_short_text', 'compile_matchers')
+                    + [inspect.getsource(_trie_pattern)],
+        })
+        return {'full': full, 'ner': ner}
+
+    def enable_decision_cache(self, cache_dir: str = DECISION_CACHE_DIR):
+        """Reuse earlier decisions in decide_batch. Call after any change to the rules."""
+        self.decision_cache = DecisionCache(cache_dir, self.rule_fingerprints())
+
+    def compile_matchers(self):
+        """
+        Build the matchers used per sentence. Call again after changing any
+        keyword set or pattern list.
+
+        Each keyword category becomes one prefix-trie regex (shared prefixes are
+        factored out, so cost per character depends on trie depth rather than on
+        the number of keywords), kept per category for keyword_categories and
+        joined into one alternation for the any-keyword check. The pattern lists
+        become one regex each.
+        """
+        self.category_matchers = {
+            category: re.compile(_trie_pattern(words))
+            for category, words in [
+                ('philosophical', self.philosophical_keywords),
+                ('religious', self.religious_protected_terms),
+                ('verb', self.meaningful_verbs),
+            ] if words
+        }
+        self.keyword_matcher = re.compile('|'.join(f'(?:{m.pattern})' for m in self.category_matchers.values()))
+        self.genealogy_matcher = re.compile('|'.join(f'(?:{p})' for p in self.genealogy_patterns))
+        self.valuable_matcher = re.compile('|'.join(f'(?:{p})' for p in self.valuable_patterns))
 
     def _load_spacy_model(self):
         """Load spaCy model with error handling."""
         try:
-            return spacy.load("en_core_web_sm")
+            # Only NER is used (is_mostly_names); skip the tagger, parser and lemmatizer
+            return spacy.load("en_core_web_sm", disable=["tagger", "parser", "attribute_ruler", "lemmatizer"])
         except OSError:
             print("Warning: spaCy model 'en_core_web_sm' not found. Some features may be limited.")
             return None
 
     def is_genealogical_text(self, text: str) -> bool:
         """Check if text is primarily genealogical information."""
-        text_lower = text.lower()
-        for pattern in self.genealogy_patterns:
-            if re.search(pattern, text_lower):
-                return True
-        return False
+        return self.genealogy_matcher.search(text.lower()) is not None
 
     def contains_meaningful_content(self, text: str) -> bool:
         """Check if text contains meaningful philosophical or religious content."""
-        text_lower = text.lower()
-        
-        # Check for philosophical keywords
-        if any(keyword in text_lower for keyword in self.philosophical_keywords):
-            return True
-            
-        # Check for protected religious terms
-        if any(term in text_lower for term in self.religious_protected_terms):
-            return True
-            
-        # Check for meaningful verbs that indicate teaching or action
-        meaningful_verbs = {
-            'teaches', 'reveals', 'declares', 'proclaims', 'speaks', 'says',
-            'commands', 'instructs', 'guides', 'leads', 'shows', 'demonstrates',
-            'manifests', 'embodies', 'represents', 'symbolizes', 'signifies',
-            'means', 'indicates', 'suggests', 'implies', 'conveys'
-        }
-        
-        if any(verb in text_lower for verb in meaningful_verbs):
-            return True
-            
-        return False
+        # Substring semantics, as before: 'god' also matches 'godly'
+        return self.keyword_matcher.search(text.lower()) is not None
+
+    def keyword_categories(self, text: str) -> Set[str]:
+        """Which keyword categories ('philosophical', 'religious', 'verb') occur in the text."""
+        # One search per category: a word listed in several categories counts for each
+        text = text.lower()
+        return {category for category, matcher in self.category_matchers.items() if matcher.search(text)}
 
-    def calculate_capital_ratio(self, text: str) -> float:
-        """Calculate ratio of capitalized words, excluding whitelisted terms."""
+    def calculate_capital_ratio(self, text: str, doc=None) -> float:
+        """Calculate ratio of capitalized words, excluding whitelisted terms.
+
+        If a spaCy doc of the text is given, its tokens are reused instead of
+        tokenizing again with NLTK.
+        """
         try:
             # Handle None or non-string inputs
             if not isinstance(text, str) or not text or not text.strip():
                 return 0.0
             
-            words = word_tokenize(text)
+            words = [token.text for token in doc] if doc is not None else word_tokenize(text)
             if len(words) < 3:
                 return 0.0
             
@@ -170,12 +379,13 @@ class AdvancedReligiousTextCleaner:
             print(f"Warning: Error tokenizing text: {e}")
             return 0.0
 
-    def is_mostly_names(self, text: str) -> bool:
-        """Check if text is mostly proper names using NER."""
+    def is_mostly_names(self, text: str, doc=None) -> bool:
+        """Check if text is mostly proper names using NER (reusing `doc` if given)."""
         if not self.nlp:
             return False
             
-        doc = self.nlp(text)
+        if doc is None:
+            doc = self.nlp(text)
         if len(doc) == 0:
             return False
             
@@ -200,116 +410,179 @@ class AdvancedReligiousTextCleaner:
                 entity_tokens.add(i)
         
         ratio = len(entity_tokens) / len(doc)
-        return ratio > 0.6  # More lenient threshold
+        return ratio > self.name_ratio_threshold  # More lenient threshold
 
     def has_meaningful_length(self, text: str) -> bool:
         """Check if text has meaningful length and complexity."""
         words = text.split()
         
         # Too short
-        if len(words) < 4:
+        if len(words) < self.min_words:
             return False
             
         # Check for very repetitive text
         unique_words = set(w.lower() for w in words if w.isalpha())
-        if len(unique_words) < len(words) * 0.3:  # Less than 30% unique words
+        if len(unique_words) < len(words) * self.min_unique_ratio:  # Less than 30% unique words
             return False
             
         return True
 
     def is_valuable_short_text(self, text: str) -> bool:
         """Check if short text is still valuable (quotes, key teachings)."""
-        text_lower = text.lower()
+        return self.valuable_matcher.search(text.lower()) is not None
+
+    def _cheap_decision(self, text) -> Dict[str, any]:
+        """Decisions that need no spaCy parse. Returns None if the NER stage must decide."""
+        # Handle None or non-string inputs
+        if not isinstance(text, str):
+            return {'keep': False, 'reason': 'invalid_input'}
+            
+        text = text.strip()
         
-        # Important short phrases
-        valuable_patterns = [
-            r'\bi am\b.*\bthat\b',  # "I am that I am" type statements
-            r'\bthou art\b',        # "Thou art that"
-            r'\bknow.*truth\b',     # Know the truth
-            r'\blive.*peace\b',     # Live in peace
-            r'\blove.*neighbor\b',  # Love thy neighbor
-            r'\bseek.*find\b',      # Seek and find
-            r'\bask.*given\b',      # Ask and it shall be given
-            r'\bblessed.*\b',       # Blessed are...
-            r'\breturn.*lord\b',    # Return to the Lord
-            r'\bpure.*heart\b',     # Pure in heart
-        ]
+        # Always keep if empty or very basic
+        if not text or len(text) < self.min_chars:
+            return {'keep': False, 'reason': 'empty_or_too_short'}
         
-        for pattern in valuable_patterns:
-            if re.search(pattern, text_lower):
-                return True
-                
-        return False
+        # Check for genealogical content first
+        if self.is_genealogical_text(text):
+            return {'keep': False, 'reason': 'genealogical_content'}
+        
+        # Check length requirements
+        if not self.has_meaningful_length(text):
+            if self.is_valuable_short_text(text):
+                return {'keep': True, 'reason': 'valuable_short_text'}
+            else:
+                return {'keep': False, 'reason': 'too_short_not_valuable'}
+        
+        # Check for meaningful content
+        if self.contains_meaningful_content(text):
+            # Even if high capital ratio, keep if meaningful
+            return {'keep': True, 'reason': 'contains_meaningful_content'}
+        
+        return None
+
+    def _ner_decision(self, text: str, doc=None) -> Dict[str, any]:
+        """Capital-ratio and proper-name checks on one parse: the text is tokenized once."""
+        text = text.strip()
+        if doc is None and self.nlp:
+            doc = self.nlp(text)
+        
+        # Check capital ratio (more lenient for meaningful content); keep or drop is
+        # decided by the name check either way, the ratio only picks the reason
+        high_capitals = self.calculate_capital_ratio(text, doc) > self.capital_ratio_threshold  # Very high threshold
+        if self.is_mostly_names(text, doc):
+            return {'keep': False, 'reason': 'mostly_names_high_capitals' if high_capitals else 'mostly_names'}
+        
+        # Default: keep if we've gotten this far
+        return {'keep': True, 'reason': 'high_capitals_but_not_names' if high_capitals else 'passed_all_filters'}
 
-    def should_keep_sentence(self, text: str, source: str = "") -> Dict[str, any]:
+    def should_keep_sentence(self, text: str, source: str = "", doc=None) -> Dict[str, any]:
         """
         Comprehensive decision on whether to keep a sentence.
         Returns dict with 'keep' boolean and 'reason' string.
         """
         try:
-            # Handle None or non-string inputs
-            if not isinstance(text, str):
-                return {'keep': False, 'reason': 'invalid_input'}
-                
-            text = text.strip()
-            
-            # Always keep if empty or very basic
-            if not text or len(text) < 3:
-                return {'keep': False, 'reason': 'empty_or_too_short'}
-            
-            # Check for genealogical content first
-            if self.is_genealogical_text(text):
-                return {'keep': False, 'reason': 'genealogical_content'}
-            
-            # Check length requirements
-            if not self.has_meaningful_length(text):
-                if self.is_valuable_short_text(text):
-                    return {'keep': True, 'reason': 'valuable_short_text'}
-                else:
-                    return {'keep': False, 'reason': 'too_short_not_valuable'}
-            
-            # Check for meaningful content
-            if self.contains_meaningful_content(text):
-                # Even if high capital ratio, keep if meaningful
-                return {'keep': True, 'reason': 'contains_meaningful_content'}
-            
-            # Check capital ratio (more lenient for meaningful content)
-            capital_ratio = self.calculate_capital_ratio(text)
-            if capital_ratio > 0.5:  # Very high threshold
-                if not self.is_mostly_names(text):
-                    return {'keep': True, 'reason': 'high_capitals_but_not_names'}
-                else:
-                    return {'keep': False, 'reason': 'mostly_names_high_capitals'}
-            
-            # Check if mostly names
-            if self.is_mostly_names(text):
-                return {'keep': False, 'reason': 'mostly_names'}
-            
-            # Default: keep if we've gotten this far
-            return {'keep': True, 'reason': 'passed_all_filters'}
+            decision = self._cheap_decision(text)
+            if decision is not None:
+                return decision
+            return self._ner_decision(text, doc)
             
         except Exception as e:
             # If any error occurs, default to keeping the sentence
             print(f"Warning: Error processing sentence: {e}")
             return {'keep': True, 'reason': 'error_default_keep'}
 
-    def clean_dataframe(self, df: pd.DataFrame, text_column: str = 'text') -> pd.DataFrame:
+    def _safe_ner_decision(self, text: str, doc=None) -> Dict[str, any]:
+        try:
+            return self._ner_decision(text, doc)
+        except Exception as e:
+            print(f"Warning: Error processing sentence: {e}")
+            return {'keep': True, 'reason': 'error_default_keep'}
+
+    def ner_worker_pool(self, n_process: int):
+        """
+        Process pool for the NER stage, used by decide_batch until closed. Each worker
+        loads spaCy once and gets this cleaner's word lists and thresholds. Create it
+        before starting any threads: the workers are forked.
+        """
+        settings = {k: v for k, v in self.__dict__.items() if k not in ('nlp', 'decision_cache', 'ner_pool')}
+        return multiprocessing.Pool(n_process, initializer=_init_ner_worker, initargs=(settings,))
+
+    def decide_batch(self, texts, batch_size: int = 1000, n_process: int = 1) -> List[Dict[str, any]]:
+        """
+        should_keep_sentence for many texts at once.
+
+        The cheap checks run first; only sentences that reach the NER stage are
+        streamed through nlp.pipe (batch_size, n_process), each distinct text parsed
+        once; inside ner_worker_pool() they go to its long-lived workers instead.
+        With a decision cache, texts decided under the same rules are not
+        re-evaluated, and new decisions are saved as a cache segment.
+        """
+        cache = self.decision_cache
+        texts = list(texts)
+        decisions = [None] * len(texts)
+        keys = [text_key(t) if cache and isinstance(t, str) else None for t in texts]
+        pending = {}  # key (or position) -> positions waiting for the NER stage
+        for i, text in enumerate(texts):
+            if keys[i] is not None:
+                decisions[i] = cache.get('full', keys[i])
+                if decisions[i] is not None:
+                    continue
+            try:
+                decisions[i] = self._cheap_decision(text)
+            except Exception as e:
+                print(f"Warning: Error processing sentence: {e}")
+                decisions[i] = {'keep': True, 'reason': 'error_default_keep'}
+            if decisions[i] is None and keys[i] is not None:
+                decisions[i] = cache.get('ner', keys[i])
+            if decisions[i] is None:
+                pending.setdefault(keys[i] if keys[i] is not None else i, []).append(i)
+            elif keys[i] is not None:
+                cache.put('full', keys[i], decisions[i])
+        
+        if pending:
+            groups = list(pending.values())
+            pending_texts = [texts[group[0]].strip() for group in groups]
+            if self.ner_pool is not None:
+                batches = [pending_texts[start:start + batch_size] for start in range(0, len(pending_texts), batch_size)]
+                ner_decisions = (d for batch in self.ner_pool.imap(_ner_decisions, batches) for d in batch)
+            else:
+                if self.nlp:
+                    docs = self.nlp.pipe(pending_texts, batch_size=batch_size, n_process=n_process)
+                else:
+                    docs = (None for _ in pending_texts)
+                ner_decisions = (self._safe_ner_decision(text, doc) for text, doc in zip(pending_texts, docs))
+            for group, decision in zip(groups, ner_decisions):
+                for i in group:
+                    decisions[i] = dict(decision)
+                if keys[group[0]] is not None:
+                    cache.put('ner', keys[group[0]], decision)
+                    cache.put('full', keys[group[0]], decision)
+        
+        if cache:
+            cache.save()
+        return decisions
+
+    def clean_dataframe(self, df: pd.DataFrame, text_column: str = 'text',
+                        batch_size: int = 1000, n_process: int = 1) -> pd.DataFrame:
         """Clean the entire dataframe and add decision metadata."""
         
         print(f"Starting with {len(df)} rows")
         
         # Apply cleaning logic
-        decisions = df[text_column].apply(
-            lambda x: self.should_keep_sentence(x, df.get('source', [''])[0] if len(df) > 0 else '')
-        )
+        decisions = self.decide_batch(df[text_column], batch_size=batch_size, n_process=n_process)
         
         # Add decision columns
-        df['keep'] = decisions.apply(lambda x: x['keep'])
-        df['filter_reason'] = decisions.apply(lambda x: x['reason'])
+        df['keep'] = [d['keep'] for d in decisions]
+        df['filter_reason'] = [d['reason'] for d in decisions]
         
+        self.print_summary(len(df), df[~df['keep']]['filter_reason'].value_counts(),
+                           df[df['keep']]['filter_reason'].value_counts())
+        return df
+
+    def print_summary(self, total_original: int, drop_reasons: pd.Series, keep_reasons: pd.Series):
         # Statistics
-        total_original = len(df)
-        total_kept = df['keep'].sum()
+        total_kept = keep_reasons.sum()
         total_dropped = total_original - total_kept
         
         print(f"\nCleaning Results:")
@@ -318,101 +591,178 @@ class AdvancedReligiousTextCleaner:
         print(f"Dropped: {total_dropped} ({total_dropped/total_original*100:.1f}%)")
         
         print(f"\nReasons for dropping:")
-        drop_reasons = df[~df['keep']]['filter_reason'].value_counts()
-        for reason, count in drop_reasons.items():
+        for reason, count in drop_reasons.sort_values(ascending=False).items():
             print(f"  {reason}: {count} ({count/total_original*100:.1f}%)")
         
         print(f"\nReasons for keeping:")
-        keep_reasons = df[df['keep']]['filter_reason'].value_counts()
-        for reason, count in keep_reasons.items():
+        for reason, count in keep_reasons.sort_values(ascending=False).items():
             print(f"  {reason}: {count} ({count/total_original*100:.1f}%)")
-        
-        return df
+
+    def clean_csv_streaming(self, input_path: str, clean_path: str, decisions_path: str, dropped_path: str,
+                            text_column: str = 'text', chunksize: int = 50_000, encoding: str = None,
+                            batch_size: int = 1000, n_process: int = 1) -> int:
+        """
+        Clean a CSV chunk by chunk with bounded memory.
+
+        The next chunk is parsed and the previous chunk's outputs are written on
+        background threads while the current chunk is being filtered. Returns the
+        number of rows processed.
+        """
+        encoding = encoding or detect_encoding(input_path)
+        print(f"Streaming {input_path} ({encoding}) in chunks of {chunksize} rows")
+        reader = pd.read_csv(input_path, encoding=encoding, chunksize=chunksize)
+        # One NER pool for the whole file, forked before the reader/writer threads
+        # start (nlp.pipe(n_process=...) would fork a new pool per chunk, under them)
+        if n_process > 1 and self.nlp:
+            self.ner_pool = self.ner_worker_pool(n_process)
+        try:
+            total, drop_reasons, keep_reasons = self._stream_chunks(
+                reader, clean_path, decisions_path, dropped_path, text_column, batch_size, n_process)
+        finally:
+            if self.ner_pool is not None:
+                self.ner_pool.close()
+                self.ner_pool.join()
+                self.ner_pool = None
+
+        if total:
+            self.print_summary(total, drop_reasons.astype('int64'), keep_reasons.astype('int64'))
+        return total
+
+    def _stream_chunks(self, reader, clean_path, decisions_path, dropped_path, text_column, batch_size, n_process):
+        drop_reasons, keep_reasons = pd.Series(dtype='int64'), pd.Series(dtype='int64')
+        total = 0
+
+        def write(frame, path, first):
+            frame.to_csv(path, mode='w' if first else 'a', header=first, index=False, encoding='utf-8')
+
+        with ThreadPoolExecutor(max_workers=1) as prefetch, ThreadPoolExecutor(max_workers=1) as writer:
+            next_chunk = prefetch.submit(next, reader, None)
+            pending_writes = []
+            first = True
+            while True:
+                chunk = next_chunk.result()
+                if chunk is None:
+                    break
+                next_chunk = prefetch.submit(next, reader, None)
+
+                decisions = self.decide_batch(chunk[text_column], batch_size=batch_size, n_process=n_process)
+                chunk['keep'] = [d['keep'] for d in decisions]
+                chunk['filter_reason'] = [d['reason'] for d in decisions]
+                kept = chunk[chunk['keep']]
+                dropped = chunk[~chunk['keep']]
+                drop_reasons = drop_reasons.add(dropped['filter_reason'].value_counts(), fill_value=0)
+                keep_reasons = keep_reasons.add(kept['filter_reason'].value_counts(), fill_value=0)
+                total += len(chunk)
+
+                # Writes go out in order on one thread; wait for the previous chunk's
+                # writes so at most two chunks are held in memory
+                for future in pending_writes:
+                    future.result()
+                dropped_cols = [text_column, 'filter_reason'] + [c for c in chunk.columns if c not in [text_column, 'keep', 'filter_reason']]
+                pending_writes = [
+                    writer.submit(write, kept.drop(columns=['keep', 'filter_reason']), clean_path, first),
+                    writer.submit(write, chunk, decisions_path, first),
+                    writer.submit(write, dropped[dropped_cols], dropped_path, first),
+                ]
+                first = False
+                print(f"  {total} rows processed")
+            for future in pending_writes:
+                future.result()
+        return total, drop_reasons, keep_reasons
+
+_worker_cleaner = None
+
+
+def _init_ner_worker(settings):
+    global _worker_cleaner
+    _worker_cleaner = AdvancedReligiousTextCleaner()
+    _worker_cleaner.__dict__.update(settings)
+
+
+def _ner_decisions(texts):
+    # In a ner_worker_pool worker: NER-stage decisions for one batch of stripped texts
+    cleaner = _worker_cleaner
+    docs = cleaner.nlp.pipe(texts) if cleaner.nlp else (None for _ in texts)
+    return [cleaner._safe_ner_decision(text, doc) for text, doc in zip(texts, docs)]
 
 def main():
     """Main function to clean the CSV file."""
     
     # Initialize cleaner
     cleaner = AdvancedReligiousTextCleaner()
+    if DECISION_CACHE_DIR:
+        cleaner.enable_decision_cache(DECISION_CACHE_DIR)
+        print(f"Decision cache: {sum(len(e) for e in cleaner.decision_cache.entries.values())} entries "
+              f"for the current rules in {DECISION_CACHE_DIR}/")
     
-    # Load main data with encoding detection
-    print("Loading religion_data.csv...")
-    df = None
-    
-    # Try different encodings
-    encodings_to_try = ['utf-8', 'latin-1', 'iso-8859-1', 'cp1252', 'utf-16']
-    
-    for encoding in encodings_to_try:
-        try:
-            print(f"Trying encoding: {encoding}")
-            df = pd.read_csv("religion_data.csv", encoding=encoding)
-            print(f"Successfully loaded with {encoding} encoding")
-            break
-        except (UnicodeDecodeError, FileNotFoundError) as e:
-            if encoding == encodings_to_try[-1]:  # Last encoding attempt
-                if isinstance(e, FileNotFoundError):
-                    print("Error: religion_data.csv not found!")
-                    return
-                else:
-                    print(f"Failed to load with any encoding. Last error: {e}")
-                    return
-            else:
-                continue
-    
-    if df is None:
-        print("Could not load the CSV file")
+    if not os.path.exists("religion_data.csv"):
+        print("Error: religion_data.csv not found!")
         return
-    
-    print(f"Loaded {len(df)} rows with columns: {list(df.columns)}")
+    try:
+        encoding = detect_encoding("religion_data.csv")
+    except UnicodeDecodeError as e:
+        print(f"Failed to load with any encoding. Last error: {e}")
+        return
+    print(f"Detected encoding: {encoding}")
     
     # Load previously dropped sentences to re-evaluate
     previously_dropped = None
-    for encoding in encodings_to_try:
+    if os.path.exists("dropped_sentences.csv"):
         try:
-            previously_dropped = pd.read_csv("dropped_sentences.csv", encoding=encoding)
+            previously_dropped = pd.read_csv("dropped_sentences.csv", encoding=detect_encoding("dropped_sentences.csv"))
             print(f"Loaded {len(previously_dropped)} previously dropped sentences for re-evaluation")
-            break
-        except (FileNotFoundError, UnicodeDecodeError):
-            continue
-    
-    if previously_dropped is None:
+        except (ValueError, OSError) as e:  # decoding, parsing (pandas errors are ValueErrors) or I/O
+            print(f"Warning: could not read dropped_sentences.csv ({type(e).__name__}: {e}) - will only process main data")
+    else:
         print("Note: dropped_sentences.csv not found - will only process main data")
     
-    # Clean the main dataframe
-    df_with_decisions = cleaner.clean_dataframe(df)
-    
-    # Create clean version (only kept sentences)
-    df_clean = df_with_decisions[df_with_decisions['keep']].copy()
-    df_clean = df_clean.drop(columns=['keep', 'filter_reason'])
-    
-    # Create dropped version for analysis
-    df_dropped = df_with_decisions[~df_with_decisions['keep']].copy()
-    
-    # Save main results (with utf-8 encoding)
-    df_clean.to_csv("religion_data_clean.csv", index=False, encoding='utf-8')
-    print(f"\nSaved {len(df_clean)} clean sentences to 'religion_data_clean.csv'")
-    
-    # Save full version with decisions for analysis
-    df_with_decisions.to_csv("religion_data_with_decisions.csv", index=False, encoding='utf-8')
-    print(f"Saved full analysis to 'religion_data_with_decisions.csv'")
-    
-    # Save dropped sentences for review
-    if len(df_dropped) > 0:
-        df_dropped[['text', 'filter_reason'] + [col for col in df.columns if col not in ['text', 'keep', 'filter_reason']]].to_csv("dropped_sentences_detailed.csv", index=False, encoding='utf-8')
-        print(f"Saved {len(df_dropped)} dropped sentences to 'dropped_sentences_detailed.csv'")
+    if CHUNK_ROWS:
+        # Streaming: constant memory, outputs written chunk by chunk
+        cleaner.clean_csv_streaming("religion_data.csv", "religion_data_clean.csv",
+                                    "religion_data_with_decisions.csv", "dropped_sentences_detailed.csv",
+                                    chunksize=CHUNK_ROWS, encoding=encoding,
+                                    batch_size=BATCH_SIZE, n_process=N_PROCESS)
+        print(f"\nSaved clean sentences to 'religion_data_clean.csv'")
+        print(f"Saved full analysis to 'religion_data_with_decisions.csv'")
+        print(f"Saved dropped sentences to 'dropped_sentences_detailed.csv'")
+    else:
+        print("Loading religion_data.csv...")
+        df = pd.read_csv("religion_data.csv", encoding=encoding)
+        print(f"Loaded {len(df)} rows with columns: {list(df.columns)}")
+        
+        # Clean the main dataframe
+        df_with_decisions = cleaner.clean_dataframe(df, batch_size=BATCH_SIZE, n_process=N_PROCESS)
+        
+        # Create clean version (only kept sentences)
+        df_clean = df_with_decisions[df_with_decisions['keep']].copy()
+        df_clean = df_clean.drop(columns=['keep', 'filter_reason'])
+        
+        # Create dropped version for analysis
+        df_dropped = df_with_decisions[~df_with_decisions['keep']].copy()
+        
+        # Save main results (with utf-8 encoding)
+        df_clean.to_csv("religion_data_clean.csv", index=False, encoding='utf-8')
+        print(f"\nSaved {len(df_clean)} clean sentences to 'religion_data_clean.csv'")
+        
+        # Save full version with decisions for analysis
+        df_with_decisions.to_csv("religion_data_with_decisions.csv", index=False, encoding='utf-8')
+        print(f"Saved full analysis to 'religion_data_with_decisions.csv'")
+        
+        # Save dropped sentences for review
+        if len(df_dropped) > 0:
+            df_dropped[['text', 'filter_reason'] + [col for col in df.columns if col not in ['text', 'keep', 'filter_reason']]].to_csv("dropped_sentences_detailed.csv", index=False, encoding='utf-8')
+            print(f"Saved {len(df_dropped)} dropped sentences to 'dropped_sentences_detailed.csv'")
     
     # Process previously dropped sentences if available
     if previously_dropped is not None:
         print(f"\n--- Re-evaluating Previously Dropped Sentences ---")
         
         # Apply new cleaning logic to previously dropped sentences
-        prev_decisions = previously_dropped['text'].apply(
-            lambda x: cleaner.should_keep_sentence(x, "")
-        )
+        prev_decisions = cleaner.decide_batch(previously_dropped['text'], batch_size=BATCH_SIZE, n_process=N_PROCESS)
         
         # Add decision columns
-        previously_dropped['keep'] = prev_decisions.apply(lambda x: x['keep'])
-        previously_dropped['new_filter_reason'] = prev_decisions.apply(lambda x: x['reason'])
+        previously_dropped['keep'] = [d['keep'] for d in prev_decisions]
+        previously_dropped['new_filter_reason'] = [d['reason'] for d in prev_decisions]
         
         # Split into kept and dropped
         prev_kept = previously_dropped[previously_dropped['keep']].copy()
@@ -470,6 +820,9 @@ def main():
         available_cols = [col for col in all_cols if col in previously_dropped.columns]
         previously_dropped[available_cols].to_csv("previously_dropped_reevaluated.csv", index=False, encoding='utf-8')
         print(f"Saved full re-evaluation to 'previously_dropped_reevaluated.csv'")
+    
+    if cleaner.decision_cache:
+        print(f"\nDecision cache: {cleaner.decision_cache.hits} decisions reused")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,11 +1,31 @@
 import pandas as pd
+import numpy as np
 import re
+import os
+import sys
+import zlib
 import hashlib
 import time
+from collections import defaultdict
+
+# Which passes main() runs after exact matching: 'lexical' (MinHash/LSH on
+# character shingles) and/or 'semantic' (FAISS range search on e5 embeddings)
+NEAR_DUPLICATE_MODES = ['lexical']
+EMBEDDING_STORE_DIR = 'religion_store'  # merged store from MPI/merge_embeddings.py
+STREAM_CHUNK_ROWS = None  # e.g. 200_000: exact-only dedup in chunks, for corpora that don't fit in memory
 
 class LocalDuplicateIdentifier:
-    def __init__(self):
-        self.similarity_threshold = 0.85
+    def __init__(self, num_perm=128, bands=16, shingle_size=5):
+        self.similarity_threshold = 0.85  # Jaccard similarity of character shingles
+        self.semantic_threshold = 0.95  # cosine similarity of e5 embeddings
+        self.num_perm = num_perm
+        self.bands = bands  # bands * rows_per_band == num_perm; candidate at J ~ (1/bands)**(1/rows)
+        self.shingle_size = shingle_size
+        self.max_bucket_size = 200  # larger LSH buckets are compared against their first member only
+        rng = np.random.default_rng(1)
+        self._prime = np.uint64((1 << 61) - 1)
+        self._perm_a = rng.integers(1, 1 << 32, size=num_perm, dtype=np.uint64)
+        self._perm_b = rng.integers(0, 1 << 32, size=num_perm, dtype=np.uint64)
 
     def normalize_text(self, text):
         """Ultra-fast text normalization."""
@@ -24,46 +44,288 @@ class LocalDuplicateIdentifier:
         normalized = self.normalize_text(text)
         return hashlib.md5(normalized.encode()).hexdigest()
     
+    def normalize_series(self, texts):
+        """Vectorized normalize_text over a whole column."""
+        texts = texts.where(texts.map(lambda t: isinstance(t, str)), '')
+        return (texts.str.lower().str.strip()
+                .str.replace(r'\s+', ' ', regex=True)
+                .str.replace(r'[.!?;,]+$', '', regex=True))
+
+    def duplicate_keys(self, df, school_column='school', text_column='text'):
+        """One 64-bit hash per row of (school, normalized text)."""
+        keys = pd.DataFrame({'school': df[school_column].astype(str),
+                             'text': self.normalize_series(df[text_column])})
+        return pd.util.hash_pandas_object(keys, index=False)
+
     def find_exact_duplicates(self, df, school_column='school', text_column='text'):
         """Only exact duplicate detection."""
         start_time = time.time()
         print(f"Starting exact duplicate detection only")
         print(f"Dataset: {len(df)} rows")
 
-        all_duplicates = []
-        for school in df[school_column].dropna().unique():
-            school_df = df[df[school_column] == school].copy()
-            if len(school_df) < 2:
-                continue
-            # Fast hash-based duplicate detection
-            school_df['text_hash'] = school_df[text_column].apply(self.get_text_hash)
-            hash_counts = school_df['text_hash'].value_counts()
-            duplicate_hashes = hash_counts[hash_counts > 1].index
-            
-            for text_hash in duplicate_hashes:
-                duplicate_rows = school_df[school_df['text_hash'] == text_hash]
-                original_idx = duplicate_rows.index[0]
-                original_text = df.loc[original_idx, text_column]
-                
-                for dup_idx in duplicate_rows.index[1:]:
-                    dup_text = df.loc[dup_idx, text_column]
-                    all_duplicates.append({
-                        'index': dup_idx,
-                        'text': dup_text,
-                        'school': school,
-                        'duplicate_type': 'exact',
-                        'duplicate_of_index': original_idx,
-                        'duplicate_of_text': original_text,
-                        'similarity_score': 1.0
-                    })
+        # One hash column and a single grouped pass: the first row of each
+        # (school, text) group is the original, every later row a duplicate of it
+        keyed = df[df[school_column].notna()]
+        keys = self.duplicate_keys(keyed, school_column, text_column)
+        original_index = pd.Series(keyed.index, index=keyed.index).groupby(keys.values).transform('first')
+        is_duplicate = keys.duplicated(keep='first')
+
+        dups = keyed[is_duplicate]
+        originals = original_index[is_duplicate]
+        all_duplicates = pd.DataFrame({
+            'index': dups.index,
+            'text': dups[text_column].values,
+            'school': dups[school_column].values,
+            'duplicate_type': 'exact',
+            'duplicate_of_index': originals.values,
+            'duplicate_of_text': df.loc[originals.values, text_column].values,
+            'similarity_score': 1.0
+        }).to_dict('records')
 
         end_time = time.time()
         print(f"\nTotal processing time: {end_time - start_time:.2f} seconds")
         print(f"Total exact duplicates found: {len(all_duplicates)}")
         return all_duplicates
 
+    def find_exact_duplicates_streaming(self, csv_path, school_column='school', text_column='text',
+                                        chunksize=200_000, clean_path=None, duplicates_path=None):
+        """
+        Exact duplicate detection over a CSV read in chunks, for corpora that do not
+        fit in memory. Only a {hash: first row} map persists across chunks; clean rows
+        are appended to clean_path as they are found. The original texts of the
+        duplicates are filled in by a second pass that reads only the text column.
+        """
+        start_time = time.time()
+        print(f"Starting streaming exact duplicate detection ({chunksize} rows per chunk)")
+        seen = {}
+        duplicate_chunks = []
+        n_rows = 0
+        for chunk_no, chunk in enumerate(pd.read_csv(csv_path, chunksize=chunksize)):
+            chunk.index = pd.RangeIndex(n_rows, n_rows + len(chunk))
+            n_rows += len(chunk)
+            keys = self.duplicate_keys(chunk, school_column, text_column).values
+            has_school = chunk[school_column].notna().values
+
+            is_duplicate = np.zeros(len(chunk), dtype=bool)
+            original = np.full(len(chunk), -1, dtype='int64')
+            for pos in np.flatnonzero(has_school):
+                key = keys[pos]
+                first = seen.setdefault(key, chunk.index[pos])
+                if first != chunk.index[pos]:
+                    is_duplicate[pos] = True
+                    original[pos] = first
+
+            dups = chunk[is_duplicate]
+            duplicate_chunks.append(pd.DataFrame({
+                'index': dups.index,
+                'text': dups[text_column].values,
+                'school': dups[school_column].values,
+                'duplicate_type': 'exact',
+                'duplicate_of_index': original[is_duplicate],
+                'duplicate_of_text': None,
+                'similarity_score': 1.0
+            }))
+            if clean_path:
+                chunk[~is_duplicate].to_csv(clean_path, mode='w' if chunk_no == 0 else 'a',
+                                            header=chunk_no == 0, index=False)
+            print(f"  {n_rows} rows read, {sum(len(d) for d in duplicate_chunks)} duplicates so far")
+
+        duplicates = pd.concat(duplicate_chunks, ignore_index=True) if duplicate_chunks else pd.DataFrame()
+        if len(duplicates):
+            wanted = set(duplicates['duplicate_of_index'])
+            original_texts = {}
+            offset = 0
+            for chunk in pd.read_csv(csv_path, usecols=[text_column], chunksize=chunksize):
+                rows = np.arange(offset, offset + len(chunk))
+                hit = np.isin(rows, list(wanted))
+                original_texts.update(zip(rows[hit], chunk[text_column].values[hit]))
+                offset += len(chunk)
+            duplicates['duplicate_of_text'] = duplicates['duplicate_of_index'].map(original_texts)
+            if duplicates_path:
+                duplicates.to_csv(duplicates_path, index=False)
+
+        print(f"\nTotal processing time: {time.time() - start_time:.2f} seconds")
+        print(f"Total exact duplicates found: {len(duplicates)} of {n_rows} rows")
+        return duplicates.to_dict('records')
+
+    def shingles(self, text):
+        """Set of hashed character shingles of the normalized text."""
+        normalized = self.normalize_text(text)
+        k = self.shingle_size
+        if len(normalized) <= k:
+            return {zlib.crc32(normalized.encode())} if normalized else set()
+        return {zlib.crc32(normalized[i:i + k].encode()) for i in range(len(normalized) - k + 1)}
+
+    def minhash_signature(self, shingle_set):
+        """num_perm MinHash values, from universal hashes (a*x + b) mod p."""
+        if not shingle_set:
+            return np.full(self.num_perm, np.iinfo(np.uint64).max, dtype=np.uint64)
+        x = np.fromiter(shingle_set, dtype=np.uint64, count=len(shingle_set))
+        hashed = (self._perm_a[:, None] * x[None, :] + self._perm_b[:, None]) % self._prime
+        return hashed.min(axis=1)
+
+    @staticmethod
+    def jaccard(a, b):
+        if not a or not b:
+            return 0.0
+        return len(a & b) / len(a | b)
+
+    @staticmethod
+    def _group_pairs(pairs):
+        """
+        Leader clustering over (i, j, score) pairs above the threshold. Rows are visited
+        in index order; a row not yet claimed is kept and claims its unclaimed neighbours,
+        so every dropped row meets the threshold against the row it is a duplicate of
+        (no transitive chains). Returns {kept: [(duplicate, score), ...]}.
+        """
+        neighbours = defaultdict(dict)
+        for i, j, score in pairs:
+            neighbours[i][j] = score
+            neighbours[j][i] = score
+        claimed = set()
+        groups = {}
+        for leader in sorted(neighbours):
+            if leader in claimed:
+                continue
+            members = [(j, score) for j, score in sorted(neighbours[leader].items())
+                       if j > leader and j not in claimed]
+            claimed.update(j for j, _ in members)
+            if members:
+                groups[leader] = members
+        return groups
+
+    def _duplicate_records(self, df, groups, text_column, school, duplicate_type):
+        records = []
+        for original_idx, members in groups.items():
+            original_text = df.at[original_idx, text_column]
+            for dup_idx, score in members:
+                records.append({
+                    'index': dup_idx,
+                    'text': df.at[dup_idx, text_column],
+                    'school': school,
+                    'duplicate_type': duplicate_type,
+                    'duplicate_of_index': original_idx,
+                    'duplicate_of_text': original_text,
+                    'similarity_score': round(float(score), 4)
+                })
+        return records
+
+    def find_near_duplicates(self, df, school_column='school', text_column='text', exclude=None):
+        """
+        Lexical near-duplicates within each school via MinHash + LSH banding.
+
+        Only pairs sharing at least one band bucket are compared (exact Jaccard on
+        the shingle sets), so the cost grows with the number of candidates rather
+        than with all pairs. `exclude` holds row labels already known to be duplicates.
+        """
+        start_time = time.time()
+        print(f"Starting lexical near-duplicate detection (MinHash/LSH, threshold {self.similarity_threshold})")
+        exclude = set(exclude or [])
+        rows_per_band = self.num_perm // self.bands
+
+        all_duplicates = []
+        for school in df[school_column].dropna().unique():
+            school_idx = [i for i in df.index[df[school_column] == school] if i not in exclude]
+            if len(school_idx) < 2:
+                continue
+            shingle_sets = {i: self.shingles(df.at[i, text_column]) for i in school_idx}
+
+            buckets = defaultdict(list)
+            for i in school_idx:
+                if not shingle_sets[i]:
+                    continue
+                signature = self.minhash_signature(shingle_sets[i])
+                for band in range(self.bands):
+                    key = signature[band * rows_per_band:(band + 1) * rows_per_band].tobytes()
+                    buckets[(band, key)].append(i)
+
+            candidates = set()
+            for members in buckets.values():
+                if len(members) < 2:
+                    continue
+                if len(members) > self.max_bucket_size:
+                    candidates.update((members[0], m) for m in members[1:])
+                else:
+                    candidates.update((a, b) for n, a in enumerate(members) for b in members[n + 1:])
+
+            pairs = []
+            for a, b in candidates:
+                score = self.jaccard(shingle_sets[a], shingle_sets[b])
+                if score >= self.similarity_threshold:
+                    pairs.append((a, b, score))
+
+            groups = self._group_pairs(pairs)
+            all_duplicates.extend(self._duplicate_records(df, groups, text_column, school, 'near_lexical'))
+
+        print(f"Lexical near-duplicates found: {len(all_duplicates)} in {time.time() - start_time:.2f} seconds")
+        return all_duplicates
+
+    def align_store_embeddings(self, df, store, text_column='text'):
+        """
+        Rows of an existing embedding store (MPI/embedding_store.py) matching each
+        df row by normalized text hash. Returns an int array (-1 = not embedded).
+        """
+        row_by_hash = {}
+        for row in range(len(store)):
+            row_by_hash.setdefault(self.get_text_hash(store.sentence(row)), row)
+        return np.array([row_by_hash.get(self.get_text_hash(t), -1) for t in df[text_column]], dtype='int64')
+
+    def find_semantic_duplicates(self, df, embeddings, store_rows, school_column='school',
+                                 text_column='text', exclude=None):
+        """
+        Semantic near-duplicates within each school via a FAISS range search on the
+        existing e5 embeddings (cosine >= semantic_threshold). Large schools use an
+        IVF index so each query only scans a few inverted lists.
+        """
+        import faiss
+
+        start_time = time.time()
+        print(f"Starting semantic near-duplicate detection (FAISS range search, threshold {self.semantic_threshold})")
+        exclude = set(exclude or [])
+        position = {label: p for p, label in enumerate(df.index)}
+
+        all_duplicates = []
+        for school in df[school_column].dropna().unique():
+            school_idx = [i for i in df.index[df[school_column] == school]
+                          if i not in exclude and store_rows[position[i]] >= 0]
+            if len(school_idx) < 2:
+                continue
+            rows = store_rows[[position[i] for i in school_idx]]
+            order = np.argsort(rows)  # sorted reads from the memory-mapped store
+            vectors = np.empty((len(rows), embeddings.shape[1]), dtype='float32')
+            vectors[order] = np.asarray(embeddings[rows[order]], dtype='float32')
+            faiss.normalize_L2(vectors)
+
+            dim = vectors.shape[1]
+            if len(vectors) >= 10000:
+                nlist = int(4 * np.sqrt(len(vectors)))
+                index = faiss.IndexIVFFlat(faiss.IndexFlatIP(dim), dim, nlist, faiss.METRIC_INNER_PRODUCT)
+                index.train(vectors)
+                index.nprobe = 8
+            else:
+                index = faiss.IndexFlatIP(dim)
+            index.add(vectors)
+            lims, D, I = index.range_search(vectors, self.semantic_threshold)
+
+            pairs = []
+            for q in range(len(vectors)):
+                for score, hit in zip(D[lims[q]:lims[q + 1]], I[lims[q]:lims[q + 1]]):
+                    if hit > q:
+                        pairs.append((school_idx[q], school_idx[hit], float(score)))
+
+            groups = self._group_pairs(pairs)
+            all_duplicates.extend(self._duplicate_records(df, groups, text_column, school, 'near_semantic'))
+
+        print(f"Semantic near-duplicates found: {len(all_duplicates)} in {time.time() - start_time:.2f} seconds")
+        return all_duplicates
+
 def main():
     finder = LocalDuplicateIdentifier()
+    if STREAM_CHUNK_ROWS:
+        finder.find_exact_duplicates_streaming("religion_data.csv", 'school', 'text', STREAM_CHUNK_ROWS,
+                                               clean_path="religion_data_cleaned.csv",
+                                               duplicates_path="duplicates_dropped.csv")
+        return
     try:
         df = pd.read_csv("religion_data.csv")
         print(f"Loaded {len(df)} rows")
@@ -75,6 +337,18 @@ def main():
         return
 
     duplicates = finder.find_exact_duplicates(df, 'school', 'text')
+    if 'lexical' in NEAR_DUPLICATE_MODES:
+        found = set(dup['index'] for dup in duplicates)
+        duplicates += finder.find_near_duplicates(df, 'school', 'text', exclude=found)
+    if 'semantic' in NEAR_DUPLICATE_MODES:
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+        from MPI.embedding_store import load_store
+        store = load_store(EMBEDDING_STORE_DIR)
+        embeddings = store.embeddings  # raises for a store with incremental updates, before the alignment pass
+        store_rows = finder.align_store_embeddings(df, store, 'text')
+        print(f"{(store_rows >= 0).sum()} of {len(df)} rows have an existing embedding")
+        found = set(dup['index'] for dup in duplicates)
+        duplicates += finder.find_semantic_duplicates(df, embeddings, store_rows, 'school', 'text', exclude=found)
     if duplicates:
         duplicate_df = pd.DataFrame(duplicates)
         duplicate_df.to_csv("duplicates_dropped.csv", index=False)
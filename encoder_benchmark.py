@@ -0,0 +1,80 @@
+import time
+import torch
+import numpy as np
+import pandas as pd
+from retrieval import RetrievalEngine, load_encoder, ENCODER_BACKENDS, MODEL_NAME
+
+# Latency and retrieval agreement of the query encoder backends (retrieval.py)
+# against the PyTorch baseline, on a fixed set of questions. Agreement is measured
+# where it matters: the per-school hits returned from the same indexes and store.
+
+REPORT_FILE = 'encoder_benchmark.csv'
+BACKENDS = ENCODER_BACKENDS  # the first one is the baseline
+THREADS = [None, 1, 4]  # intra-op thread settings to try (None = library default)
+K_PER_SCHOOL = 5
+REPEATS = 3  # timed passes over the query set
+QUERIES = [
+    "What is the meaning of life?", "Is free will compatible with determinism?", "What is the nature of the soul?",
+    "What makes a state just?", "Can we trust our senses?", "Why does evil exist if god is good?",
+    "Is virtue sufficient for happiness?", "How do words get their meaning?", "What is the good life?",
+    "Does god exist?", "What is consciousness?", "What do we owe to others?", "Is morality objective?",
+    "What is the relation between mind and body?", "How should we face death?", "What can we know for certain?",
+    "Is knowledge justified true belief?", "What is time?", "What is beauty?", "Should we fear the gods?",
+    "How should wealth be distributed?", "Is there progress in history?", "What is the role of reason in ethics?",
+    "Are we responsible for our desires?", "What is the self?", "Is pleasure the highest good?",
+    "What grounds political authority?", "Can machines think?", "What is the nature of causation?",
+    "How should we treat animals?",
+]
+
+
+def encode(model, queries):
+    return np.asarray(model.encode(["query: " + q for q in queries], normalize_embeddings=True), dtype='float32')
+
+
+def timed(model):
+    # Per-query latency (batch of 1, as a single user sees it) and whole-set batch time
+    latencies = []
+    for _ in range(REPEATS):
+        for q in QUERIES:
+            t0 = time.perf_counter()
+            encode(model, [q])
+            latencies.append(time.perf_counter() - t0)
+    t0 = time.perf_counter()
+    encode(model, QUERIES)
+    return np.array(latencies), time.perf_counter() - t0
+
+
+def hit_rows(engine, vecs):
+    results = engine.search_schools_batch(vecs, [engine.schools] * len(vecs), [K_PER_SCHOOL] * len(vecs),
+                                          [-1.0] * len(vecs))
+    return [{(school, row) for school, hits in r.items() for _, row in hits} for r in results]
+
+
+engine = RetrievalEngine(batching=False, encoder=BACKENDS[0])
+default_threads = torch.get_num_threads()  # set_num_threads is process-wide, so restore it explicitly
+baseline_vecs = None
+rows = []
+for backend in BACKENDS:
+    for threads in THREADS:
+        t0 = time.perf_counter()
+        model = load_encoder(MODEL_NAME, backend, threads or default_threads)
+        load_seconds = time.perf_counter() - t0
+        encode(model, QUERIES[:2])  # warmup
+        latencies, batch_seconds = timed(model)
+        vecs = encode(model, QUERIES)
+        if baseline_vecs is None:
+            baseline_vecs, baseline_hits = vecs, hit_rows(engine, vecs)
+        hits = hit_rows(engine, vecs)
+        agreement = np.mean([len(h & b) / max(len(b), 1) for h, b in zip(hits, baseline_hits)])
+        rows.append({'backend': backend, 'threads': threads or 'default', 'load_s': load_seconds,
+                     'p50_ms': 1000 * np.percentile(latencies, 50), 'p95_ms': 1000 * np.percentile(latencies, 95),
+                     'batch_ms_per_query': 1000 * batch_seconds / len(QUERIES),
+                     'min_cosine_to_baseline': float(np.min(np.sum(vecs * baseline_vecs, axis=1))),
+                     f'hit_agreement@{K_PER_SCHOOL}': agreement})
+        print(f"{backend} threads={threads}: p50 {rows[-1]['p50_ms']:.1f} ms, agreement {agreement:.3f}")
+        del model
+
+report = pd.DataFrame(rows)
+report.to_csv(REPORT_FILE, index=False)
+print(f"\nReport saved to {REPORT_FILE}")
+print(report.to_string(index=False))
@@ -1,10 +1,9 @@
 import streamlit as st
-from sentence_transformers import SentenceTransformer
-import faiss
-import numpy as np
 from collections import defaultdict
 import os
 from PIL import Image
+from retrieval import MultiCorpusEngine
+from retrieval_service import RetrievalClient, ServiceWarming, SERVICE_URL
 book_urls = {
     "A Treatise Concerning The Principles Of Human Knowledge": "https://www.gutenberg.org/cache/epub/4723/pg4723-images.html",
     "A Treatise Of Human Nature": "https://www.gutenberg.org/cache/epub/4705/pg4705-images.html",
@@ -67,29 +66,22 @@ book_urls = {
 }
 
 
-# Load model and data
+# Retrieval runs in a separate warm process (retrieval_service.py) when one is
+# listening on RETRIEVAL_URL; otherwise the model and the indexes of every built
+# corpus (philosophy, religion) load in this process, in the background, so the
+# page renders while they warm up
 @st.cache_resource
-def load_data():
-    model = SentenceTransformer("intfloat/e5-large-v2") #may need to change this to e5
+def load_backend():
+    client = RetrievalClient(SERVICE_URL)
+    if client.available():
+        return client
+    return MultiCorpusEngine(background=True)
 
-    # Absolute paths
-    base_path = os.path.dirname(__file__)
-    index_path = os.path.join(base_path, "philosophy_faiss.index")
-    data_path = os.path.join(base_path, "philosophy_embeddings_merged.npz")
-
-    # Load FAISS index and metadata
-    index = faiss.read_index(index_path)
-    data = np.load(data_path, allow_pickle=True)
-    metadata = data['metadata']
-    embeddings = data['embeddings']
-
-    return model, index, metadata, embeddings
-
-model, index, metadata, embeddings = load_data()
+backend = load_backend()
+startup = backend.stats()
 
 # Show banner image
-base_path = os.path.dirname(__file__)
-banner_path = os.path.join(base_path, "./logos/logo1.png")
+banner_path = os.path.join(os.path.dirname(__file__), "./logos/logo1.png")
 banner = Image.open(banner_path)
 st.image(banner, use_container_width=True)
 
@@ -101,7 +93,7 @@ query = st.text_input(
 )
 
 
-# Custom emojis for each school
+# Custom emojis for known schools; the school list itself comes from the indexes
 school_emojis = {
     "analytic": "🔍",
     "aristotle": "🏛️",
@@ -117,16 +109,19 @@ school_emojis = {
     "rationalism": "📐",
     "stoicism": "🗿"
 }
+school_corpora = backend.school_corpora
 with st.sidebar:
     st.markdown("## 🧭 Filter Schools")
     st.markdown("Uncheck to hide a school from the results:")
 
     selected_schools = []
 
-    for school in sorted(school_emojis.keys()):
-        is_checked = st.checkbox(f"{school_emojis[school]} {school.replace('_', ' ').title()}", value=True)
-        if is_checked:
-            selected_schools.append(school)
+    for corpus in sorted({c for corpora in school_corpora.values() for c in corpora}):
+        st.markdown(f"**{corpus.replace('_', ' ').title()}**")
+        for school in sorted(s for s, corpora in school_corpora.items() if corpora[0] == corpus):
+            is_checked = st.checkbox(f"{school_emojis.get(school, '📖')} {school.replace('_', ' ').title()}", value=True)
+            if is_checked:
+                selected_schools.append(school)
 
 
 st.markdown("""
@@ -176,26 +171,30 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 
+if not startup['ready']:
+    st.sidebar.info(f"⏳ Warming up ({startup['status']}); a question asked now is answered once it is ready.")
+
 # If user submits query
 if query:
-    query_vec = model.encode(["query: " + query], normalize_embeddings=True).astype("float32")
-    k = 5000
-    D, I = index.search(query_vec, k)
-
-    # Collect top 2 results per school (above similarity threshold)
+    # Collect top 2 results per selected school (above similarity threshold)
     school_hits = defaultdict(list)
-    for dist, idx in zip(D[0], I[0]):
-        m = metadata[idx]
-        school = m.get('school', 'Unknown School')
-        author = m.get('author', 'Unknown Author')
-        book = m.get('title', 'Unknown Book')
-        book_url = book_urls.get(book, '#')  # fallback if unknown
-        sentence = m.get('sentence_str', 'No sentence available')
-        similarity = dist
-        if similarity < 0.2:
-            continue
-        if len(school_hits[school]) < 2:
-            formatted = formatted = f'<em>“{sentence}”</em><br><a href="{book_url}" target="_blank" title="Click and Ctrl+F to search this sentence." style="text-decoration:none;">({book})</a> — {author}'
+    with st.spinner("Searching..." if startup['ready'] else "Loading the model, first answer in a moment..."):
+        try:
+            results = backend.search(query, selected_schools, k_per_school=2, min_similarity=0.2)
+        except ServiceWarming as e:
+            st.info(f"⏳ The retrieval service is still warming up ({e}); ask again in a moment.")
+            results = {}
+        except OSError as e:  # service unreachable or timed out (URLError, socket.timeout)
+            st.error(f"The retrieval service at {SERVICE_URL} did not answer: {e}")
+            results = {}
+    for school, hits in results.items():
+        for m in hits:
+            similarity = m['similarity']
+            author = m.get('author', 'Unknown Author')
+            book = m.get('title', 'Unknown Book')
+            book_url = book_urls.get(book, '#')  # fallback if unknown
+            sentence = m.get('sentence') or 'No sentence available'
+            formatted = f'<em>“{sentence}”</em><br><a href="{book_url}" target="_blank" title="Click and Ctrl+F to search this sentence." style="text-decoration:none;">({book})</a> — {author}'
             school_hits[school].append((similarity, formatted))
 
     # Sort schools by highest matching sentence similarity
@@ -210,25 +209,33 @@ if query:
     cards_html = '<div class="card-container">'
 
     for school in schools_with_results:
-        if school not in selected_schools:
-            continue
-        else:
-            hits = sorted(school_hits[school], reverse=True)[:2]
-            emoji = school_emojis.get(school, "📖")
+        hits = sorted(school_hits[school], reverse=True)[:2]
+        emoji = school_emojis.get(school, "📖")
 
-            # Start card
-            card_html = f"""
-            <div class="school-card">
-                <div class="school-header">{emoji} {school.replace('_', ' ').title()}</div>
-            """
+        # Start card
+        card_html = f"""
+        <div class="school-card">
+            <div class="school-header">{emoji} {school.replace('_', ' ').title()}</div>
+        """
 
-            for _, sentence in hits:
-                card_html += f"""<div class="sentence">{sentence}</div>"""
+        for _, sentence in hits:
+            card_html += f"""<div class="sentence">{sentence}</div>"""
 
-            card_html += "</div>"  # close school-card
-            cards_html += card_html
+        card_html += "</div>"  # close school-card
+        cards_html += card_html
 
     cards_html += "</div>"  # close card-container
 
     # Render all at once
     st.markdown(cards_html, unsafe_allow_html=True)
+
+# Cache counters, written after the query so they include this rerun
+stats = backend.stats()
+st.sidebar.caption(
+    f"{'Retrieval service' if isinstance(backend, RetrievalClient) else 'In-process retrieval'} · "
+    f"query cache: {stats['query_cache']['hits']} hits / {stats['query_cache']['misses']} misses · "
+    f"results cache: {stats['search_cache']['hits']} hits / {stats['search_cache']['misses']} misses"
+)
+if stats['ready']:
+    with st.sidebar.expander("Startup time"):
+        st.text("\n".join(f"{name}: {seconds:.2f}s" for name, seconds in stats['startup'].items()))
@@ -0,0 +1,221 @@
+import os
+import sys
+import json
+import hashlib
+import subprocess
+import time
+import numpy as np
+import pandas as pd
+
+# One-command rebuild of a corpus: dedup -> clean -> embed -> semantic -> merge -> index.
+#
+# Intermediate tables are Parquet files in PIPELINE_DIR (read once, typed, no CSV
+# re-parsing), and a table produced in this run is handed to the next stage in
+# memory. Each stage records a fingerprint of its inputs, parameters and code in
+# pipeline_state.json and is skipped when that fingerprint is unchanged and its
+# outputs exist.
+#
+#   python pipeline.py                 # run whatever is out of date
+#   python pipeline.py clean embed     # also force these stages
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(ROOT, 'MPI'))
+sys.path.insert(0, os.path.join(ROOT, 'Religion Cleaning'))
+
+INPUT_FILE = 'religion_data.csv'
+TEXT_COLUMN = 'text'
+SCHOOL_COLUMN = 'school'
+PIPELINE_DIR = 'religion_pipeline'  # Parquet tables, embedding shards and pipeline_state.json
+STORE_DIR = 'religion_store'
+SCHOOL_INDEX_DIR = 'religion_school_indexes'
+DEDUP_MODES = ['lexical']  # near-duplicate passes after exact matching ('lexical', 'semantic')
+# 'semantic' runs after embed, on this build's own vectors, and its duplicates are left out of the store
+EMBED_RANKS = 4  # MPI ranks for embed_mpi.py (1 = run it without mpiexec)
+MPIEXEC = 'mpiexec'
+
+STAGES = ['dedup', 'clean', 'embed', 'semantic', 'merge', 'index']
+STATE_FILE = os.path.join(PIPELINE_DIR, 'pipeline_state.json')
+DEDUPED = os.path.join(PIPELINE_DIR, 'deduped.parquet')
+DUPLICATES = os.path.join(PIPELINE_DIR, 'duplicates_dropped.parquet')
+CLEAN = os.path.join(PIPELINE_DIR, 'clean.parquet')
+DECISIONS = os.path.join(PIPELINE_DIR, 'decisions.parquet')
+EMBEDDINGS_DIR = os.path.join(PIPELINE_DIR, 'embeddings')
+SEMANTIC_DUPLICATES = os.path.join(PIPELINE_DIR, 'semantic_dropped.parquet')
+DUPLICATE_COLUMNS = ['index', 'text', 'school', 'duplicate_type', 'duplicate_of_index', 'duplicate_of_text',
+                     'similarity_score']
+
+_frames = {}  # Parquet path -> DataFrame written earlier in this run
+
+
+def file_digest(path, state):
+    # Content hash of a file, reused while its size and mtime are unchanged;
+    # directories hash the names, sizes and mtimes of their files
+    if os.path.isdir(path):
+        entries = sorted((os.path.relpath(os.path.join(d, f), path), os.stat(os.path.join(d, f)).st_size,
+                          os.stat(os.path.join(d, f)).st_mtime_ns)
+                         for d, _, files in os.walk(path) for f in files)
+        return hashlib.sha1(json.dumps(entries).encode()).hexdigest()
+    stat = os.stat(path)
+    cached = state.setdefault('digests', {}).get(path)
+    if cached and cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns:
+        return cached['sha1']
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 24), b''):
+            sha1.update(block)
+    state['digests'][path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha1': sha1.hexdigest()}
+    return sha1.hexdigest()
+
+
+def stage_fingerprint(inputs, code, params, state):
+    parts = {
+        'inputs': {p: file_digest(p, state) for p in inputs},
+        'code': {c: file_digest(os.path.join(ROOT, c), state) for c in code},
+        'params': params,
+    }
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def write_frame(df, path):
+    df.to_parquet(path, index=False)
+    _frames[path] = df
+
+
+def read_frame(path):
+    return _frames[path] if path in _frames else pd.read_parquet(path)
+
+
+def run_dedup():
+    from duplicate_finder import LocalDuplicateIdentifier
+    from csv_cleaner import detect_encoding
+
+    df = pd.read_csv(INPUT_FILE, encoding=detect_encoding(INPUT_FILE))
+    print(f"Loaded {len(df)} rows from {INPUT_FILE}")
+    finder = LocalDuplicateIdentifier()
+    duplicates = finder.find_exact_duplicates(df, SCHOOL_COLUMN, TEXT_COLUMN)
+    if 'lexical' in DEDUP_MODES:
+        found = set(dup['index'] for dup in duplicates)
+        duplicates += finder.find_near_duplicates(df, SCHOOL_COLUMN, TEXT_COLUMN, exclude=found)
+    duplicate_df = pd.DataFrame(duplicates, columns=DUPLICATE_COLUMNS)
+    duplicate_df.to_parquet(DUPLICATES, index=False)
+    deduped = df[~df.index.isin(duplicate_df['index'])].reset_index(drop=True)
+    write_frame(deduped, DEDUPED)
+    print(f"Dedup: {len(duplicate_df)} duplicates dropped, {len(deduped)} rows left")
+
+
+def run_clean():
+    from csv_cleaner import AdvancedReligiousTextCleaner, BATCH_SIZE, N_PROCESS
+
+    df = read_frame(DEDUPED).copy()
+    decisions = AdvancedReligiousTextCleaner().clean_dataframe(df, TEXT_COLUMN, batch_size=BATCH_SIZE,
+                                                               n_process=N_PROCESS)
+    decisions.to_parquet(DECISIONS, index=False)
+    clean = decisions[decisions['keep']].drop(columns=['keep', 'filter_reason']).reset_index(drop=True)
+    write_frame(clean, CLEAN)
+
+
+def embed_columns():
+    columns = pd.read_parquet(CLEAN).columns if CLEAN not in _frames else _frames[CLEAN].columns
+    return [c for c in ('title', 'author', SCHOOL_COLUMN) if c in columns] + [TEXT_COLUMN]
+
+
+def run_embed():
+    # embed_mpi.py checkpoints and caches by sentence, so only new text is encoded
+    env = dict(os.environ, EMBED_INPUT_FILE=os.path.abspath(CLEAN), EMBED_TEXT_COLUMN=TEXT_COLUMN,
+               EMBED_METADATA_COLUMNS=','.join(embed_columns()), EMBED_OUTPUT_DIR=os.path.abspath(EMBEDDINGS_DIR))
+    command = [sys.executable, os.path.join(ROOT, 'MPI', 'embed_mpi.py')]
+    if EMBED_RANKS > 1:
+        command = [MPIEXEC, '-n', str(EMBED_RANKS)] + command
+    subprocess.run(command, env=env, check=True)
+
+
+def run_semantic():
+    # Semantic near-duplicates among the cleaned rows, on the vectors embed just wrote
+    # (so the result depends only on this build's input, never on a previous store)
+    duplicates = []
+    if 'semantic' in DEDUP_MODES:
+        from duplicate_finder import LocalDuplicateIdentifier
+        from merge_embeddings import npz_array_shape
+
+        df = read_frame(CLEAN)
+        files = sorted(f for f in os.listdir(EMBEDDINGS_DIR) if f.startswith('embeddings_rank_') and f.endswith('.npz'))
+        dimension = npz_array_shape(os.path.join(EMBEDDINGS_DIR, files[0]), 'embeddings')[1] if files else 0
+        # Shard rows gathered into one clean-row-ordered matrix on disk, not in RAM
+        vectors_path = os.path.join(PIPELINE_DIR, 'semantic_vectors.npy')
+        vectors = np.lib.format.open_memmap(vectors_path, mode='w+', dtype='float32', shape=(len(df), dimension))
+        rows = np.full(len(df), -1, dtype='int64')
+        for file in files:
+            with np.load(os.path.join(EMBEDDINGS_DIR, file)) as data:
+                indices = data['indices']
+                vectors[indices] = data['embeddings']
+                rows[indices] = indices
+        duplicates = LocalDuplicateIdentifier().find_semantic_duplicates(df, vectors, rows, SCHOOL_COLUMN,
+                                                                        TEXT_COLUMN)
+        del vectors
+        os.remove(vectors_path)
+    pd.DataFrame(duplicates, columns=DUPLICATE_COLUMNS).to_parquet(SEMANTIC_DUPLICATES, index=False)
+    print(f"Semantic: {len(duplicates)} duplicates left out of the store")
+
+
+def run_merge():
+    from merge_embeddings import merge_shards
+    merge_shards(EMBEDDINGS_DIR, STORE_DIR, exclude_rows=pd.read_parquet(SEMANTIC_DUPLICATES)['index'].to_numpy())
+
+
+def run_index():
+    from merge_embeddings import build_indexes
+    build_indexes(STORE_DIR, SCHOOL_INDEX_DIR)
+
+
+# stage -> (function, inputs, code files, outputs)
+PLAN = {
+    'dedup': (run_dedup, [INPUT_FILE], ['Religion Cleaning/duplicate_finder.py'], [DEDUPED, DUPLICATES]),
+    'clean': (run_clean, [DEDUPED], ['Religion Cleaning/csv_cleaner.py'], [CLEAN, DECISIONS]),
+    'embed': (run_embed, [CLEAN], ['MPI/embed_mpi.py'], [EMBEDDINGS_DIR]),
+    'semantic': (run_semantic, [CLEAN, EMBEDDINGS_DIR], ['Religion Cleaning/duplicate_finder.py'],
+                 [SEMANTIC_DUPLICATES]),
+    'merge': (run_merge, [EMBEDDINGS_DIR, SEMANTIC_DUPLICATES], ['MPI/merge_embeddings.py', 'MPI/embedding_store.py'],
+              [STORE_DIR]),
+    'index': (run_index, [STORE_DIR], ['MPI/merge_embeddings.py', 'MPI/faiss_indexes.py'], [SCHOOL_INDEX_DIR]),
+}
+PARAMS = {
+    'dedup': {'text': TEXT_COLUMN, 'school': SCHOOL_COLUMN, 'modes': [m for m in DEDUP_MODES if m != 'semantic']},
+    'semantic': {'text': TEXT_COLUMN, 'school': SCHOOL_COLUMN, 'enabled': 'semantic' in DEDUP_MODES},
+    'clean': {'text': TEXT_COLUMN},
+    'embed': {'text': TEXT_COLUMN},
+}
+
+
+def main(force=()):
+    os.makedirs(PIPELINE_DIR, exist_ok=True)
+    state = {}
+    if os.path.exists(STATE_FILE):
+        with open(STATE_FILE) as f:
+            state = json.load(f)
+    stages = state.setdefault('stages', {})
+
+    timings = []
+    for name in STAGES:
+        fn, inputs, code, outputs = PLAN[name]
+        fingerprint = stage_fingerprint(inputs, code, PARAMS.get(name, {}), state)
+        if name not in force and stages.get(name) == fingerprint and all(os.path.exists(o) for o in outputs):
+            print(f"[{name}] inputs unchanged, skipping")
+            continue
+        print(f"[{name}] running...")
+        t0 = time.time()
+        fn()
+        timings.append((name, time.time() - t0))
+        stages[name] = fingerprint
+        with open(STATE_FILE, 'w') as f:  # after every stage, so a failure resumes from there
+            json.dump(state, f, indent=2)
+
+    for name, seconds in timings:
+        print(f"  {name}: {seconds:.1f}s")
+    print("Pipeline up to date.")
+
+
+if __name__ == '__main__':
+    unknown = [s for s in sys.argv[1:] if s not in STAGES]
+    if unknown:
+        sys.exit(f"Unknown stage(s) {unknown}, expected some of {STAGES}")
+    main(force=set(sys.argv[1:]))
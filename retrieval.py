@@ -0,0 +1,460 @@
+import time
+_import_t0 = time.perf_counter()
+import os
+import re
+import queue
+import threading
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+import numpy as np
+import faiss
+from MPI.embedding_store import load_store
+IMPORT_SECONDS = time.perf_counter() - _import_t0  # numpy + faiss, reported in the startup breakdown
+
+# Query side of the app: the e5 model, the per-school FAISS indexes and the store,
+# with process-wide caches. Used in-process by philo_qa.py, or behind
+# retrieval_service.py so that one warm process serves many UI workers.
+# MultiCorpusEngine answers over several corpora (philosophy, religion) at once.
+
+MODEL_NAME = "intfloat/e5-large-v2"
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+SCHOOL_INDEX_DIR = os.path.join(BASE_PATH, "philosophy_school_indexes")
+STORE_DIR = os.path.join(BASE_PATH, "philosophy_store")
+# corpus -> (school index dir, store dir), built by MPI/merge_embeddings.py or pipeline.py;
+# corpora that have not been built are skipped. The unified corpus covers both
+# domains with one index set: use it instead of the two, not with them.
+CORPORA = {
+    "philosophy": (SCHOOL_INDEX_DIR, STORE_DIR),
+    "religion": (os.path.join(BASE_PATH, "religion_school_indexes"), os.path.join(BASE_PATH, "religion_store")),
+}
+UNIFIED_CORPORA = {
+    "religion_philosophy": (os.path.join(BASE_PATH, "religion_philosophy_school_indexes"),
+                            os.path.join(BASE_PATH, "religion_philosophy_store")),
+}
+# With compact (sq8 / sq_fp16 / IVF-PQ) school indexes, fetch this many times more
+# candidates and re-rank them exactly against the full-precision store vectors.
+# Indexes that keep the float vectors (flat, IVF-flat, HNSW) already score exactly
+# and are searched for k as is.
+RESCORE_FACTOR = 5
+EXACT_SCORE_INDEXES = (faiss.IndexFlat, faiss.IndexIVFFlat, faiss.IndexHNSWFlat)
+# Micro-batching: queries arriving within BATCH_WINDOW_MS of the first one (up to
+# MAX_BATCH) share one model.encode call and one index.search per school
+BATCH_WINDOW_MS = 5
+MAX_BATCH = 32
+# Query encoder runtime. All options run the same e5 weights, so query vectors stay
+# comparable with the indexed corpus (no re-embedding); see encoder_benchmark.py.
+#   'torch'      - PyTorch, full precision (baseline)
+#   'torch-int8' - PyTorch with Linear layers dynamically quantized to int8
+#   'onnx'       - ONNX Runtime export of the model
+#   'onnx-int8'  - ONNX Runtime export with dynamic int8 quantization
+ENCODER_BACKEND = os.environ.get("RETRIEVAL_ENCODER", "torch")
+ENCODER_THREADS = None  # intra-op threads for encoding (None = library default)
+ONNX_DIR = os.path.join(BASE_PATH, "onnx_encoders")  # exports are written here on first use
+ONNX_QUANT_CONFIG = "avx2"  # or 'avx512', 'avx512_vnni', 'arm64'
+ENCODER_BACKENDS = ["torch", "torch-int8", "onnx", "onnx-int8"]
+
+
+class LRUCache:
+    """Small thread-safe LRU map with hit/miss counters, shared by all sessions."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+def normalize_query(query):
+    return re.sub(r"\s+", " ", query.strip().lower())
+
+
+def index_version(index_dir):
+    """Version published by MPI/index_updates.py (None = plain layout from merge_embeddings.py)."""
+    current = os.path.join(index_dir, "CURRENT")
+    if not os.path.exists(current):
+        return None
+    with open(current) as f:
+        return f.read().strip()
+
+
+def load_encoder(model_name=MODEL_NAME, backend=ENCODER_BACKEND, threads=ENCODER_THREADS):
+    """SentenceTransformer for `model_name` running on one of ENCODER_BACKENDS."""
+    import torch
+    from sentence_transformers import SentenceTransformer
+    if backend not in ENCODER_BACKENDS:
+        raise ValueError(f"Unknown encoder backend '{backend}', expected one of {ENCODER_BACKENDS}")
+    if threads:
+        torch.set_num_threads(threads)
+    if backend.startswith("torch"):
+        model = SentenceTransformer(model_name, device="cpu" if backend == "torch-int8" else None)
+        if backend == "torch-int8":
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        return model
+
+    export_dir = os.path.join(ONNX_DIR, model_name.replace("/", "__"))
+    if not os.path.exists(export_dir):
+        SentenceTransformer(model_name, backend="onnx").save_pretrained(export_dir)
+    model_kwargs = {}
+    if threads:
+        import onnxruntime
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = threads
+        model_kwargs["session_options"] = session_options
+    if backend == "onnx-int8":
+        file_name = f"model_qint8_{ONNX_QUANT_CONFIG}.onnx"
+        if not os.path.exists(os.path.join(export_dir, "onnx", file_name)):
+            from sentence_transformers import export_dynamic_quantized_onnx_model
+            export_dynamic_quantized_onnx_model(SentenceTransformer(export_dir, backend="onnx"), ONNX_QUANT_CONFIG,
+                                                export_dir)
+        model_kwargs["file_name"] = os.path.join("onnx", file_name)
+    return SentenceTransformer(export_dir, backend="onnx", model_kwargs=model_kwargs)
+
+
+def hit_dict(store, row, **extra):
+    # Metadata of a store row with its text under 'sentence', shared by all corpora
+    return dict(store.metadata[row], sentence=store.sentence(row), row=row, **extra)
+
+
+def rescore_factor(index):
+    # RESCORE_FACTOR for indexes storing compressed codes, 1 for exact-score ones
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    return 1 if isinstance(inner, EXACT_SCORE_INDEXES) else max(RESCORE_FACTOR, 1)
+
+
+def read_index_mmap(path):
+    """Open an index without copying its vectors into RAM: flat codes (also HNSW / SQ
+    storage) are mapped with IO_FLAG_MMAP_IFC where faiss has it, IVF lists with IO_FLAG_MMAP."""
+    mmap_ifc = getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+    if mmap_ifc:
+        try:
+            return faiss.read_index(path, faiss.IO_FLAG_MMAP | mmap_ifc | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError:
+            pass  # IVF lists can only be mapped by the plain file reader
+    return faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+
+
+class QueryBatcher:
+    """Collects concurrent search requests and runs them as batches on a worker thread."""
+
+    def __init__(self, engine, max_batch=MAX_BATCH, window_ms=BATCH_WINDOW_MS):
+        self.engine = engine
+        self.max_batch = max_batch
+        self.window = window_ms / 1000.0
+        self.batches = 0
+        self.requests = 0
+        self._queue = queue.Queue()
+        threading.Thread(target=self._run, name="query-batcher", daemon=True).start()
+
+    def submit(self, query, schools, k_per_school, min_similarity, data):
+        future = Future()
+        self._queue.put((future, query, schools, k_per_school, min_similarity, data))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self.batches += 1
+            self.requests += len(batch)
+            try:
+                query_vecs = self.engine.encode_queries([item[1] for item in batch])
+                by_version = defaultdict(list)  # requests made during an index update
+                for i, item in enumerate(batch):
+                    by_version[id(item[5])].append(i)
+                for positions in by_version.values():
+                    results = self.engine.search_schools_batch(
+                        query_vecs[positions], [batch[i][2] for i in positions], [batch[i][3] for i in positions],
+                        [batch[i][4] for i in positions], batch[positions[0]][5])
+                    for i, result in zip(positions, results):
+                        batch[i][0].set_result(result)
+            except Exception as e:
+                for item in batch:
+                    if not item[0].done():
+                        item[0].set_exception(e)
+
+
+class RetrievalEngine:
+    """search(query, schools, k_per_school) -> {school: [hit, ...]}, hits best first.
+
+    Each hit is the row's metadata plus 'sentence' (the store's text, whether the
+    corpus calls it 'sentence_str' or 'text'), 'similarity' and 'row'. Index
+    updates are picked up on the next call: the indexes, store and result cache of
+    one version are swapped in together.
+
+    With background=True the constructor returns at once and the indexes, encoder
+    and a first encode are warmed on a thread; `ready` / `status` report progress,
+    calls that need them wait, and `timings` holds the startup breakdown.
+    """
+
+    def __init__(self, index_dir=SCHOOL_INDEX_DIR, store_dir=STORE_DIR, model_name=MODEL_NAME, batching=True,
+                 encoder=ENCODER_BACKEND, threads=ENCODER_THREADS, background=False):
+        self.index_dir = index_dir
+        self.store_dir = store_dir
+        self.model_name = model_name
+        self.encoder = encoder
+        self.threads = threads
+        self.model = None
+        self.query_vec_cache = LRUCache(maxsize=2048)  # survives index updates
+        self._lock = threading.Lock()
+        self._data = None
+        self.batcher = QueryBatcher(self) if batching else None
+        self.timings = {"import numpy / faiss": IMPORT_SECONDS}
+        self.status = "starting"
+        self._started = time.perf_counter()
+        self._loaded = threading.Event()  # indexes open (schools known)
+        self._ready = threading.Event()
+        self._error = None
+        if background:
+            threading.Thread(target=self._warm, name="retrieval-warmup", daemon=True).start()
+        else:
+            self._warm()
+            self.wait_ready()
+
+    def _phase(self, name, fn):
+        self.status = name
+        t0 = time.perf_counter()
+        result = fn()
+        self.timings[name] = time.perf_counter() - t0
+        return result
+
+    def _warm(self):
+        # Indexes first (mmap, fast), so schools are known while the model loads
+        try:
+            self._phase("open indexes + store (mmap)", self.refresh)
+            self._loaded.set()
+            if self.encoder is None:  # vector-side only (a MultiCorpusEngine corpus)
+                self.status = "ready"
+                return
+            self._phase("import torch / sentence_transformers", lambda: __import__("sentence_transformers"))
+            self.model = self._phase(f"load encoder ({self.encoder})",
+                                     lambda: load_encoder(self.model_name, self.encoder, self.threads))
+            self._phase("first encode", lambda: self.model.encode(["query: warmup"], normalize_embeddings=True))
+            self.timings["total to ready"] = time.perf_counter() - self._started
+            self.status = "ready"
+        except Exception as e:
+            self._error = e
+            self.status = f"failed: {type(e).__name__}: {e}"
+        finally:
+            self._loaded.set()
+            self._ready.set()
+
+    @property
+    def ready(self):
+        return self._ready.is_set() and self._error is None
+
+    def wait_ready(self, timeout=None):
+        if not self._ready.wait(timeout):
+            return False
+        if self._error is not None:
+            raise RuntimeError(f"Retrieval engine failed to start: {self.status}") from self._error
+        return True
+
+    def startup_report(self):
+        return "\n".join(f"  {name:<40} {seconds:7.2f}s" for name, seconds in self.timings.items())
+
+    def refresh(self):
+        version = index_version(self.index_dir)
+        if self._data is not None and self._data[0] == version:
+            return
+        with self._lock:
+            if self._data is not None and self._data[0] == version:
+                return
+            version_dir = os.path.join(self.index_dir, version) if version else self.index_dir
+            # Load one FAISS index per school (built by MPI/merge_embeddings.py) and metadata
+            school_indexes = {}
+            for fname in sorted(os.listdir(version_dir)):
+                if fname.endswith(".index"):
+                    school_indexes[fname[:-len(".index")]] = read_index_mmap(os.path.join(version_dir, fname))
+            # Memory-mapped, pickle-free store: pages are shared between processes and
+            # only the rows a query touches are ever read
+            store = load_store(self.store_dir)
+            self._data = (version, school_indexes, store, LRUCache(maxsize=4096))
+
+    def _wait_loaded(self):
+        self._loaded.wait()
+        if self._data is None:
+            self.wait_ready()  # raises the startup error
+        return self._data
+
+    @property
+    def schools(self):
+        """School names, from the per-school indexes (one per metadata 'school' value)."""
+        return sorted(self._wait_loaded()[1])
+
+    @property
+    def school_corpora(self):
+        """{school: [corpus]}, the corpus being named after the store directory."""
+        corpus = os.path.basename(os.path.normpath(self.store_dir))
+        return {school: [corpus] for school in self.schools}
+
+    def encode_queries(self, queries):
+        """(n x dim) query vectors; only texts not seen before (normalized) go through the transformer, in one call."""
+        keys = [normalize_query(q) for q in queries]
+        vecs = [self.query_vec_cache.get(key) for key in keys]
+        missing = {key: q for key, q, vec in zip(keys, queries, vecs) if vec is None}
+        if missing:
+            encoded = self.model.encode(["query: " + q for q in missing.values()], normalize_embeddings=True)
+            for key, vec in zip(missing, np.asarray(encoded, dtype="float32")):
+                self.query_vec_cache.put(key, vec[None, :])
+            fresh = dict(zip(missing, encoded))
+            vecs = [vec if vec is not None else fresh[key][None, :] for key, vec in zip(keys, vecs)]
+        return np.vstack(vecs).astype("float32")
+
+    def encode_query(self, query):
+        """Encode a query, skipping the transformer when the normalized text was seen before."""
+        return self.encode_queries([query])
+
+    def search_schools_batch(self, query_vecs, schools, k_per_school, min_similarity, data=None):
+        """
+        Per query i: {school: [(similarity, row), ...]} over schools[i]. Queries that
+        ask the same school with the same k share one index.search call.
+        """
+        _, school_indexes, store, _ = data or self._data
+        results = [{} for _ in range(len(query_vecs))]
+        groups = defaultdict(list)
+        for i, (query_schools, k) in enumerate(zip(schools, k_per_school)):
+            for school in query_schools:
+                if school in school_indexes:
+                    groups[(school, k)].append(i)
+        for (school, k), positions in groups.items():
+            factor = rescore_factor(school_indexes[school])
+            D, I = school_indexes[school].search(query_vecs[positions], k * factor)
+            for row, i in enumerate(positions):
+                ids = I[row][I[row] != -1]
+                if factor > 1 and len(ids):
+                    sims = store.rescore(query_vecs[i:i + 1], ids)[0]
+                    top = np.argsort(-sims)[:k]
+                    candidates = zip(sims[top], ids[top])
+                else:
+                    candidates = zip(D[row], I[row])
+                hits = [(float(dist), int(idx)) for dist, idx in candidates if idx != -1 and dist >= min_similarity[i]]
+                if hits:
+                    results[i][school] = hits
+        return results
+
+    def search_schools(self, query_vec, schools, k_per_school=2, min_similarity=0.2, data=None):
+        """Return {school: [(similarity, row), ...]} searching only the given schools."""
+        return self.search_schools_batch(query_vec, [schools], [k_per_school], [min_similarity], data)[0]
+
+    def search(self, query, schools, k_per_school=2, min_similarity=0.2):
+        """search_schools() with results cached per (query, school), so toggling a school reuses the rest."""
+        self.wait_ready()
+        self.refresh()
+        data = self._data  # one consistent version for the whole call
+        search_cache = data[3]
+        normalized = normalize_query(query)
+        school_hits, missing = {}, []
+        for school in schools:
+            hits = search_cache.get((normalized, school, k_per_school, min_similarity))
+            if hits is None:
+                missing.append(school)
+            elif hits:
+                school_hits[school] = hits
+        if missing:
+            if self.batcher:
+                fresh = self.batcher.submit(query, missing, k_per_school, min_similarity, data).result()
+            else:
+                fresh = self.search_schools(self.encode_query(query), missing, k_per_school, min_similarity, data)
+            for school in missing:
+                hits = [self._hit(data, sim, row) for sim, row in fresh.get(school, [])]
+                search_cache.put((normalized, school, k_per_school, min_similarity), hits)
+                if hits:
+                    school_hits[school] = hits
+        return school_hits
+
+    def _hit(self, data, similarity, row):
+        return hit_dict(data[2], row, similarity=similarity)
+
+    def stats(self):
+        version, _, _, search_cache = self._data or (None, None, None, LRUCache(0))
+        batcher = self.batcher
+        return {"version": version, "encoder": self.encoder, "ready": self.ready, "status": self.status,
+                "startup": dict(self.timings),
+                "batching": {"batches": batcher.batches, "requests": batcher.requests} if batcher else None,
+                "query_cache": {"hits": self.query_vec_cache.hits, "misses": self.query_vec_cache.misses},
+                "search_cache": {"hits": search_cache.hits, "misses": search_cache.misses}}
+
+
+class MultiCorpusEngine(RetrievalEngine):
+    """RetrievalEngine over several corpora, answered in one call.
+
+    One encoder and one (batched) encode per query; the corpora's indexes are then
+    searched in parallel and their hits merged into one top-k per school, so a
+    corpus adds no sequential latency. A school present in several corpora gets
+    the best hits of all of them. Hits carry 'corpus' and that corpus' 'row'.
+    """
+
+    def __init__(self, corpora=CORPORA, **kwargs):
+        self.corpora = {name: dirs for name, dirs in corpora.items() if os.path.isdir(dirs[0])}
+        if not self.corpora:
+            raise FileNotFoundError(f"None of the corpora {sorted(corpora)} has been built")
+        self.engines = {}
+        self.pool = ThreadPoolExecutor(max_workers=len(self.corpora), thread_name_prefix="corpus-search")
+        super().__init__(index_dir=None, store_dir=None, **kwargs)
+
+    def refresh(self):
+        if not self.engines:
+            self.engines = {name: RetrievalEngine(index_dir, store_dir, batching=False, encoder=None)
+                            for name, (index_dir, store_dir) in self.corpora.items()}
+        for engine in self.engines.values():
+            engine.refresh()
+        datas = {name: engine._data for name, engine in self.engines.items()}
+        versions = tuple(data[0] for data in datas.values())
+        if self._data is not None and self._data[0] == versions:
+            return
+        with self._lock:
+            school_corpora = defaultdict(list)
+            for name, data in datas.items():
+                for school in data[1]:
+                    school_corpora[school].append(name)
+            self._data = (versions, dict(school_corpora), datas, LRUCache(maxsize=4096))
+
+    @property
+    def school_corpora(self):
+        """{school: [corpus, ...]}"""
+        return self._wait_loaded()[1]
+
+    def search_schools_batch(self, query_vecs, schools, k_per_school, min_similarity, data=None):
+        datas = (data or self._data)[2]
+        per_corpus = self.pool.map(
+            lambda name: self.engines[name].search_schools_batch(query_vecs, schools, k_per_school, min_similarity,
+                                                                 datas[name]), datas)
+        merged = [defaultdict(list) for _ in range(len(query_vecs))]
+        for name, results in zip(datas, per_corpus):
+            for i, school_hits in enumerate(results):
+                for school, hits in school_hits.items():
+                    merged[i][school] += [(sim, (name, row)) for sim, row in hits]
+        return [{school: sorted(hits, reverse=True)[:k] for school, hits in school_hits.items()}
+                for school_hits, k in zip(merged, k_per_school)]
+
+    def _hit(self, data, similarity, key):
+        name, row = key
+        return hit_dict(data[2][name][2], row, similarity=similarity, corpus=name)
@@ -0,0 +1,53 @@
+import time
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from retrieval import RetrievalEngine
+
+# Throughput and latency of RetrievalEngine.search under concurrent callers, with
+# micro-batching on and off. Every query is distinct, so neither the query-vector
+# cache nor the result cache helps and each request pays for encoding and search.
+
+REPORT_FILE = 'retrieval_benchmark.csv'
+CONCURRENCY = [1, 4, 16, 64]
+QUERIES_PER_LEVEL = 256
+K_PER_SCHOOL = 2
+TOPICS = ["the meaning of life", "free will and determinism", "the nature of the soul", "justice and the state",
+          "knowledge and perception", "god and evil", "virtue and happiness", "language and meaning"]
+
+
+def run_level(engine, concurrency, offset):
+    queries = [f"{TOPICS[i % len(TOPICS)]} ({offset + i})" for i in range(QUERIES_PER_LEVEL)]
+    schools = engine.schools
+
+    def one(query):
+        t0 = time.perf_counter()
+        engine.search(query, schools, K_PER_SCHOOL)
+        return time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = np.array(list(pool.map(one, queries)))
+    return len(queries) / (time.perf_counter() - t0), latencies
+
+
+rows = []
+offset = 0
+for batching in (False, True):
+    engine = RetrievalEngine(batching=batching)
+    engine.search("warmup", engine.schools, K_PER_SCHOOL)
+    for concurrency in CONCURRENCY:
+        before = engine.stats()['batching']
+        qps, latencies = run_level(engine, concurrency, offset)
+        offset += QUERIES_PER_LEVEL
+        after = engine.stats()['batching']
+        rows.append({'batching': batching, 'concurrency': concurrency, 'qps': qps,
+                     'p50_ms': 1000 * np.percentile(latencies, 50), 'p95_ms': 1000 * np.percentile(latencies, 95),
+                     'mean_batch': ((after['requests'] - before['requests']) / max(after['batches'] - before['batches'], 1)
+                                    if batching else 1.0)})
+        print(f"batching={batching} concurrency={concurrency}: {qps:.1f} queries/s")
+
+report = pd.DataFrame(rows)
+report.to_csv(REPORT_FILE, index=False)
+print(f"\nReport saved to {REPORT_FILE}")
+print(report.to_string(index=False))
@@ -0,0 +1,167 @@
+import os
+import sys
+import json
+import asyncio
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+from retrieval import MAX_BATCH
+
+# Localhost retrieval service: one warm process owns the model and the indexes and
+# stores of every corpus (retrieval.MultiCorpusEngine) and answers JSON over HTTP,
+# so UI workers stay small and never block on encoding. asyncio accepts connections;
+# requests wait on a thread pool while the engine's batcher encodes and searches
+# them together.
+#
+#   python retrieval_service.py            # serve on HOST:PORT
+#
+#   POST /search   {"query": ..., "schools": [...], "k_per_school": 2, "min_similarity": 0.2}
+#                  -> {"results": {school: [hit, ...]}}; all schools when "schools" is
+#                  omitted, 400 for a malformed body, 503 {"error": "warming"} before ready
+#   GET  /schools  -> {"schools": [...], "corpora": {school: [corpus, ...]}}
+#   GET  /stats    -> cache counters, index version and startup breakdown
+#   GET  /health   -> {"ok": true, "ready": bool, "status": warmup phase}
+#
+# The port opens immediately and the engine warms in the background. /search
+# answers 503 until the model is loaded rather than holding the request (and the
+# client's timeout) open; /schools only waits for the indexes to open (mmap, fast).
+
+HOST = '127.0.0.1'
+PORT = 8765
+WORKERS = 2 * MAX_BATCH  # requests in flight; enough to fill a micro-batch while the previous one runs
+SERVICE_URL = os.environ.get('RETRIEVAL_URL', f'http://{HOST}:{PORT}')
+CLIENT_TIMEOUT = 30  # seconds
+
+
+class ServiceWarming(Exception):
+    """The service is up but its engine is still warming (HTTP 503); str() is the warmup phase."""
+
+
+class RetrievalService:
+    def __init__(self, engine, workers=WORKERS):
+        self.engine = engine
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    async def call(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def route(self, method, path, body):
+        if method == 'POST' and path == '/search':
+            try:
+                request = json.loads(body or b'{}')
+                query = request['query']
+                schools = request.get('schools')  # None = all, resolved off the event loop
+                k_per_school = int(request.get('k_per_school', 2))
+                min_similarity = float(request.get('min_similarity', 0.2))
+                if not isinstance(query, str) or not (schools is None or isinstance(schools, list)):
+                    raise TypeError("'query' must be a string and 'schools' a list")
+            except (ValueError, KeyError, TypeError) as e:
+                return 400, {'error': f'bad /search request: {type(e).__name__}: {e}'}
+            if not self.engine.wait_ready(0):  # raises (-> 500) if warmup failed
+                return 503, {'error': 'warming', 'status': self.engine.status}
+            results = await self.call(
+                lambda: self.engine.search(query, self.engine.schools if schools is None else schools,
+                                           k_per_school, min_similarity))
+            return 200, {'results': results}
+        if method == 'GET' and path == '/schools':
+            school_corpora = await self.call(lambda: self.engine.school_corpora)
+            return 200, {'schools': sorted(school_corpora), 'corpora': school_corpora}
+        if method == 'GET' and path == '/stats':
+            return 200, self.engine.stats()
+        if method == 'GET' and path == '/health':
+            return 200, {'ok': True, 'ready': self.engine.ready, 'status': self.engine.status}
+        return 404, {'error': f'no route {method} {path}'}
+
+    async def handle(self, reader, writer):
+        # Minimal HTTP/1.1 with keep-alive: request line, headers, Content-Length body
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                try:
+                    status, payload = await self.route(method, path, body)
+                except Exception as e:
+                    status, payload = 500, {'error': f'{type(e).__name__}: {e}'}
+                data = json.dumps(payload).encode('utf-8')
+                reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error',
+                          503: 'Service Unavailable'}[status]
+                writer.write(f'HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\n'
+                             f'Content-Length: {len(data)}\r\n\r\n'.encode('latin-1') + data)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def report_startup(self):
+        try:
+            await self.call(self.engine.wait_ready)
+            print(f"Retrieval engine ready:\n{self.engine.startup_report()}")
+        except RuntimeError as e:
+            print(e)
+
+    async def serve(self, host=HOST, port=PORT):
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"Retrieval service listening on http://{host}:{port}")
+        asyncio.get_running_loop().create_task(self.report_startup())
+        async with server:
+            await server.serve_forever()
+
+
+class RetrievalClient:
+    """Same search() / schools / school_corpora / stats() interface as MultiCorpusEngine, over HTTP."""
+
+    def __init__(self, url=SERVICE_URL, timeout=CLIENT_TIMEOUT):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def _request(self, path, payload=None):
+        data = json.dumps(payload).encode('utf-8') if payload is not None else None
+        request = urllib.request.Request(self.url + path, data=data, headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            if e.code == 503:
+                raise ServiceWarming(json.loads(e.read()).get('status', 'warming')) from None
+            raise
+
+    def available(self):
+        try:
+            return self._request('/health').get('ok', False)
+        except (urllib.error.URLError, OSError):
+            return False
+
+    @property
+    def schools(self):
+        return self._request('/schools')['schools']
+
+    @property
+    def school_corpora(self):
+        return self._request('/schools')['corpora']
+
+    def search(self, query, schools, k_per_school=2, min_similarity=0.2):
+        return self._request('/search', {'query': query, 'schools': list(schools), 'k_per_school': k_per_school,
+                                         'min_similarity': min_similarity})['results']
+
+    def stats(self):
+        return self._request('/stats')
+
+
+if __name__ == '__main__':
+    from retrieval import MultiCorpusEngine
+    engine = MultiCorpusEngine(background=True)
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else PORT
+    asyncio.run(RetrievalService(engine).serve(HOST, port))